@@ -1,18 +1,21 @@
 """
 This is an implementation of content classification using the Calais service.  Any interactions with Calais should
-be contained within this module.  By keeping the classification functionality in a self contained module/class it
-would be easy to enhance Chatter to support a plugin model for content classification using a custom classifier.
+be contained within this module.  It is the 'calais' classifier plugin, see chatter.classify for the plugin model.
 """
 import logging
 
-import requests
-
 import chatter.config as config
+from chatter.classify import Classifier, ClassifierError, ContentRejectedError
+from chatter.httpsession import get_calais_session
 
 clog = logging.getLogger(__name__)
 
+# Client error statuses that are about the account or the service rather than the content sent, bad credentials and
+# rate limiting, any other client error means Calais will not classify that content
+SERVICE_ERROR_STATUSES = (401, 403, 429)
+
 
-class ClassifierCalais:
+class ClassifierCalais(Classifier):
     def __init__(self):
         self.headers = {'Content-Type': 'text/raw',
                         'x-ag-access-token': config.calais_api_token,
@@ -27,20 +30,27 @@ class ClassifierCalais:
         # If there is no legit content to classify don't make the call
         if len(title) < 5 and len(content) < 10:
             return None
+        # The headers are built for each call, rather than set on the shared ones, so classify is safe to call from
+        # several threads at once
+        headers = dict(self.headers)
         if len(title) > 5:
             title = title.strip().replace("\r", " ").replace("\n", " ")
-            self.headers['x-calais-DocumentTitle'] = title.encode('utf-8')
+            headers['x-calais-DocumentTitle'] = title.encode('utf-8')
             if len(content) < 5:
                 content = title
         topics = []
+        error = None
+        rejected = False
         num_attempts = 0
         # The Free Calais service is very flaky so we will give it a few tries
         while num_attempts < config.url_maintenance_request_retries:
             num_attempts += 1
             try:
-                r = requests.post(config.calais_tag_url, headers=self.headers, data=content.encode('utf-8'), timeout=5)
+                r = get_calais_session().post(config.calais_tag_url, headers=headers,
+                                              data=content.encode('utf-8'), timeout=5)
                 # We had a successful call so don't try any more
                 num_attempts = config.url_maintenance_request_retries
+                error = None
                 if r.ok:
                     r_json = r.json()
                     for k, v in r_json.items():
@@ -52,6 +62,15 @@ class ClassifierCalais:
                     # and either fixed or added as an option here to allow retries to
                     # occur
                     clog.error('Calais request status code: %s Message: %s', r.status_code, r.text)
+                    error = f'Calais request status code: {r.status_code}'
+                    rejected = r.status_code < 500 and r.status_code not in SERVICE_ERROR_STATUSES
             except Exception as e:
                 clog.error(e)
+                error = e
+        # Failures are raised rather than returned as no topics, so the content is classified again later instead of
+        # being stored with no topics
+        if rejected:
+            raise ContentRejectedError(error)
+        if error is not None:
+            raise ClassifierError(error)
         return topics
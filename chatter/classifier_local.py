@@ -0,0 +1,116 @@
+"""
+This is an implementation of content classification that runs entirely in process, the 'local' classifier plugin.  It
+learns from the topics already stored for urls, typically by the Calais classifier, and needs no network access.
+
+Each topic is represented by the centroid of the TF-IDF vectors of the urls labelled with it, and content is scored
+against every topic by the cosine similarity of its own TF-IDF vector to the topic's centroid.
+"""
+import logging
+import math
+import threading
+import time
+from collections import Counter, defaultdict
+
+import chatter.config as config
+import chatter.dbutil as db
+from chatter.classify import Classifier, ClassifierError, ContentRejectedError
+
+clog = logging.getLogger(__name__)
+
+# Maximum number of classified urls to learn from
+LOCAL_TRAINING_URLS = 50000
+# Number of heaviest terms kept for each topic centroid, fewer terms make classifying faster
+LOCAL_CENTROID_TERMS = 400
+# Topics are only returned if they score at least this, and only the best few of them
+LOCAL_MIN_SCORE = 0.1
+LOCAL_MAX_TOPICS = 3
+# Words shorter than this are ignored
+LOCAL_MIN_WORD_LENGTH = 3
+
+
+def get_terms(title, content):
+    """Return the term counts for a title and content, counting title words twice as they say more about a story."""
+    words = config.get_word_split().split(f'{title or ""} {title or ""} {content or ""}'.lower())
+    return Counter(word for word in words if len(word) >= LOCAL_MIN_WORD_LENGTH)
+
+
+class TopicModel:
+    """TF-IDF nearest centroid model, with an inverted index from term to the topic centroids containing it."""
+
+    def __init__(self, documents):
+        """Train the model from (title, content, [(topic, score), ...]) documents."""
+        doc_terms = []
+        doc_freq = Counter()
+        for title, content, topics in documents:
+            terms = get_terms(title, content)
+            if len(terms) > 0 and len(topics) > 0:
+                doc_terms.append((terms, topics))
+                doc_freq.update(terms.keys())
+        self.num_documents = len(doc_terms)
+        self.idf = {term: math.log((1 + self.num_documents) / (1 + freq)) + 1 for term, freq in doc_freq.items()}
+        centroids = defaultdict(Counter)
+        for terms, topics in doc_terms:
+            vector = self.vectorize(terms)
+            for topic, score in topics:
+                centroid = centroids[topic]
+                for term, weight in vector.items():
+                    centroid[term] += weight * (score or 1)
+        self.index = defaultdict(list)
+        for topic, centroid in centroids.items():
+            top_terms = centroid.most_common(LOCAL_CENTROID_TERMS)
+            norm = math.sqrt(sum(weight * weight for _, weight in top_terms))
+            for term, weight in top_terms:
+                self.index[term].append((topic, weight / norm))
+        self.num_topics = len(centroids)
+
+    def vectorize(self, terms):
+        """Return the L2 normalised TF-IDF vector for term counts, ignoring terms never seen in training."""
+        vector = {term: (1 + math.log(count)) * self.idf[term] for term, count in terms.items() if term in self.idf}
+        norm = math.sqrt(sum(weight * weight for weight in vector.values()))
+        return {term: weight / norm for term, weight in vector.items()} if norm > 0 else {}
+
+    def classify(self, title, content):
+        scores = Counter()
+        for term, weight in self.vectorize(get_terms(title, content)).items():
+            for topic, topic_weight in self.index.get(term, ()):
+                scores[topic] += weight * topic_weight
+        return [{'topic': topic, 'score': round(score, 3)} for topic, score in scores.most_common(LOCAL_MAX_TOPICS)
+                if score >= LOCAL_MIN_SCORE]
+
+
+class ClassifierLocal(Classifier):
+
+    # Classifying takes no I/O so there is no benefit in splitting batches up across threads
+    batch_size = 500
+
+    def __init__(self):
+        self.model = None
+        self.model_lock = threading.Lock()
+
+    def get_model(self):
+        """Return the topic model, training it from the stored url topics the first time it is needed.  Raises
+        ClassifierError if there is nothing to learn from yet, the model is trained again on the next call."""
+        with self.model_lock:
+            if self.model is None:
+                start = time.time()
+                rows = db.get_classified_urls(LOCAL_TRAINING_URLS)
+                model = TopicModel((row['title'], row['description'], list(zip(row['topics'], row['scores'])))
+                                   for row in rows)
+                clog.info('Trained local classifier on %s urls with %s topics in %.1f seconds',
+                          model.num_documents, model.num_topics, time.time() - start)
+                if model.num_topics == 0:
+                    raise ClassifierError('There are no classified urls for the local classifier to learn from')
+                self.model = model
+            return self.model
+
+    def classify(self, title, content):
+        title = title or ''
+        content = content or ''
+        # Same threshold as the other classifiers for there being enough content to classify
+        if len(title) < 5 and len(content) < 10:
+            return None
+        topics = self.get_model().classify(title, content)
+        if len(topics) == 0:
+            # Not an answer, the content is too unlike anything the model was trained on
+            raise ContentRejectedError(f'No topic scored at least {LOCAL_MIN_SCORE}')
+        return topics
@@ -0,0 +1,286 @@
+"""
+This module provides the topic classification stage for chatter.  Classification requests are made concurrently and
+their results are cached by the content classified, so a wire story syndicated across many sites is only sent to the
+classifier once.
+
+The classifier itself is a plugin chosen with config.classifier, either one of the names in CLASSIFIERS or the dotted
+path of any class implementing the Classifier interface.
+
+Classification runs as its own stage, separate from url maintenance, working through the urls that have metadata but
+no topics yet.  A circuit breaker stops calls to a failing classifier for a while, the urls waiting on it simply stay
+unclassified until it recovers.  Content the classifier rejects is tried again a few times and then given no topics,
+rejections say nothing about the health of the classifier so they never trip the circuit breaker.
+"""
+import importlib
+import logging
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import chatter.dbutil as db
+import chatter.config as config
+from chatter.util import LRUCache, get_hashed_string
+
+clog = logging.getLogger(__name__)
+
+CLASSIFY_SLEEP_TIME = .75
+# Maximum number of classification requests in flight at the same time
+CLASSIFY_WORKERS = 8
+# Number of unclassified urls fetched from the database at a time
+CLASSIFY_BATCH_SIZE = 100
+# Number of title and description topic results kept in memory
+CLASSIFY_CACHE_SIZE = 50000
+# Stop calling the classifier after this many failures in a row, and leave it alone this many seconds before trying it
+# again
+CLASSIFY_BREAKER_FAILURES = 5
+CLASSIFY_BREAKER_RESET_SECONDS = 60
+# Urls whose content the classifier rejects are tried again after this many seconds, doubled for each further
+# rejection, and are given no topics once they have been rejected this many times
+CLASSIFY_RETRY_SECONDS = 5 * 60
+CLASSIFY_MAX_ATTEMPTS = 3
+# Topic stored for content the classifier has nothing to say about, so it is not picked up for classifying again
+NO_TOPICS = (('None', 1),)
+WHITESPACE_RE = re.compile(r'\s+')
+# The built in classifier plugins
+CLASSIFIERS = {
+    'calais': 'chatter.classifier_calais.ClassifierCalais',
+    'local': 'chatter.classifier_local.ClassifierLocal',
+}
+
+_topic_classifier = None
+_topic_classifier_lock = threading.Lock()
+
+
+class ClassifierError(Exception):
+    """Raised by a classifier that could not classify content, the content is left to be classified again later."""
+
+
+class CircuitOpenError(ClassifierError):
+    """Raised instead of calling a classifier while its circuit breaker is open."""
+
+
+class ContentRejectedError(ClassifierError):
+    """Raised by a classifier that is working but will not classify the content it was given, for example because it
+    is too large or in an unsupported language."""
+
+
+class Classifier:
+    """Interface for classifier plugins.  Plugins are created with no arguments and must be safe to call from several
+    threads at once."""
+
+    # Number of items the classify stage hands to classify_many at a time
+    batch_size = 1
+
+    def classify(self, title, content):
+        """Return a list of {'topic': ..., 'score': ...} dicts for the title and content, or None if there is not
+        enough content to classify.  Raise ContentRejectedError if the classifier refuses this content, or
+        ClassifierError if the content could not be classified for any other reason."""
+        raise NotImplementedError
+
+    def classify_many(self, items):
+        """Given (title, content) pairs return the classify result for each of them, in the same order.  Content the
+        classifier rejects gets its ContentRejectedError in place of a result, so the rest of the batch is kept."""
+        results = []
+        for title, content in items:
+            try:
+                results.append(self.classify(title, content))
+            except ContentRejectedError as e:
+                results.append(e)
+        return results
+
+
+def create_classifier(name=None):
+    """Create the classifier plugin with the given name or dotted class path, defaulting to config.classifier."""
+    name = name or config.classifier
+    module_name, _, class_name = CLASSIFIERS.get(name, name).rpartition('.')
+    return getattr(importlib.import_module(module_name), class_name)()
+
+
+class CircuitBreaker:
+    """Closed, calls go through.  After failure_threshold failures in a row it opens and refuses calls for
+    reset_seconds, after which a single trial call is let through, closing it again if it succeeds or reopening it if
+    it fails."""
+
+    def __init__(self, failure_threshold=CLASSIFY_BREAKER_FAILURES, reset_seconds=CLASSIFY_BREAKER_RESET_SECONDS):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.lock = threading.Lock()
+        self.failures = 0
+        self.opened_at = None
+        self.trial_running = False
+
+    def allow(self):
+        """Return True if a call may be made now, the caller must report how it went with succeeded or failed."""
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if self.trial_running or time.time() < self.opened_at + self.reset_seconds:
+                return False
+            self.trial_running = True
+            return True
+
+    def succeeded(self):
+        with self.lock:
+            if self.opened_at is not None:
+                clog.info('Classifier is working again, closing the circuit breaker')
+            self.failures = 0
+            self.opened_at = None
+            self.trial_running = False
+
+    def failed(self):
+        with self.lock:
+            self.failures += 1
+            if self.trial_running or (self.opened_at is None and self.failures >= self.failure_threshold):
+                clog.warning('Classifier failed %s times in a row, not calling it for %s seconds', self.failures,
+                             self.reset_seconds)
+                self.opened_at = time.time()
+            self.trial_running = False
+
+    def seconds_until_retry(self):
+        """Return how long until a call will be allowed, 0 if calls are allowed now."""
+        with self.lock:
+            if self.opened_at is None:
+                return 0
+            return max(0, self.opened_at + self.reset_seconds - time.time())
+
+
+def get_content_key(title, description):
+    """Return the cache key for a title and description, ignoring any differences in whitespace."""
+    title = WHITESPACE_RE.sub(' ', title or '').strip()
+    description = WHITESPACE_RE.sub(' ', description or '').strip()
+    return get_hashed_string(f'{title}\n{description}')
+
+
+class TopicClassifier:
+    """Thread safe, caching front end to a classifier."""
+
+    def __init__(self, classifier=None, cache_size=CLASSIFY_CACHE_SIZE):
+        self.classifier = classifier or create_classifier()
+        self.cache = LRUCache(cache_size)
+        self.breaker = CircuitBreaker()
+        self.stats_lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _to_topics(topics):
+        # The classifier returns None when there is not enough content to classify, and an empty list when it looked at
+        # the content and found no topics in it
+        if isinstance(topics, ContentRejectedError):
+            return topics
+        if not topics:
+            return NO_TOPICS
+        return tuple((topic['topic'], topic['score']) for topic in topics)
+
+    def _classify_many(self, keys, items):
+        if not self.breaker.allow():
+            raise CircuitOpenError('Classifier circuit breaker is open')
+        try:
+            results = self.classifier.classify_many(items)
+        except ContentRejectedError:
+            # The classifier answered, it just did not like this content
+            self.breaker.succeeded()
+            raise
+        except Exception:
+            self.breaker.failed()
+            raise
+        self.breaker.succeeded()
+        topics = [self._to_topics(result) for result in results]
+        for key, key_topics in zip(keys, topics):
+            if not isinstance(key_topics, ContentRejectedError):
+                self.cache.put(key, key_topics)
+        return topics
+
+    def classify_urls(self, urls, executor):
+        """Given rows of real_url_hash, title and description return the url_topics rows for them, and the real_url_hash
+        of each url the classifier rejected or failed on unexpectedly.  Urls sharing the same content are classified
+        once, and the distinct content not already cached is handed to the classifier in batches of its batch_size,
+        run concurrently on the executor.  Urls that could not be classified are left out of the url_topics rows."""
+        by_key = {}
+        for url in urls:
+            by_key.setdefault(get_content_key(url['title'], url['description']), []).append(url)
+        topics_by_key = {}
+        rejected_keys = []
+        misses = []
+        for key in by_key:
+            topics = self.cache.get(key)
+            if topics is None:
+                misses.append(key)
+            else:
+                topics_by_key[key] = topics
+        batch_size = max(1, self.classifier.batch_size)
+        futures = []
+        for i in range(0, len(misses), batch_size):
+            keys = misses[i:i + batch_size]
+            items = [(by_key[key][0]['title'], by_key[key][0]['description']) for key in keys]
+            futures.append((keys, executor.submit(self._classify_many, keys, items)))
+        for keys, future in futures:
+            try:
+                for key, topics in zip(keys, future.result()):
+                    if isinstance(topics, ContentRejectedError):
+                        clog.debug('Classifier rejected url %s: %s', by_key[key][0]['real_url_hash'], topics)
+                        rejected_keys.append(key)
+                    else:
+                        topics_by_key[key] = topics
+            except CircuitOpenError:
+                clog.debug('Skipped classifying %s urls while the circuit breaker is open', len(keys))
+            except ContentRejectedError as e:
+                clog.warning('Classifier rejected %s urls: %s', len(keys), e)
+                rejected_keys.extend(keys)
+            except ClassifierError as e:
+                clog.error('Unable to classify %s urls: %s', len(keys), e)
+            except Exception:
+                clog.exception('Unexpected error classifying %s urls', len(keys))
+                rejected_keys.extend(keys)
+        with self.stats_lock:
+            self.misses += len(misses)
+            self.hits += len(urls) - len(misses)
+        url_topics = []
+        for key, topics in topics_by_key.items():
+            for url in by_key[key]:
+                url_topics.extend((url['real_url_hash'], topic, score) for topic, score in topics)
+        rejected = [url['real_url_hash'] for key in rejected_keys for url in by_key[key]]
+        return url_topics, rejected
+
+    def hit_rate(self):
+        with self.stats_lock:
+            total = self.hits + self.misses
+            return self.hits / total if total > 0 else 0
+
+
+def get_topic_classifier():
+    """Return the topic classifier shared by everything in this process that classifies urls."""
+    global _topic_classifier
+    with _topic_classifier_lock:
+        if _topic_classifier is None:
+            _topic_classifier = TopicClassifier()
+        return _topic_classifier
+
+
+def classify_urls():
+    """Classify any urls with metadata but no topics until stopped."""
+    topic_classifier = get_topic_classifier()
+    with ThreadPoolExecutor(max_workers=CLASSIFY_WORKERS, thread_name_prefix='chatter-classify') as executor:
+        while True:
+            wait = topic_classifier.breaker.seconds_until_retry()
+            if wait > 0:
+                # The classifier is failing, leave the urls queued up until it is time to try it again
+                time.sleep(wait)
+                continue
+            urls = db.get_urls_to_classify(CLASSIFY_BATCH_SIZE)
+            start = time.time()
+            url_topics, rejected = topic_classifier.classify_urls(urls, executor)
+            # Rejected urls are left to be tried again later, unless they have run out of attempts in which case they
+            # are given no topics so they are not picked up again
+            for real_url_hash in db.add_classify_failures(rejected, CLASSIFY_RETRY_SECONDS, CLASSIFY_MAX_ATTEMPTS):
+                clog.warning('Giving up classifying url %s after %s attempts', real_url_hash, CLASSIFY_MAX_ATTEMPTS)
+                url_topics.extend((real_url_hash, topic, score) for topic, score in NO_TOPICS)
+            db.save_url_topics(url_topics)
+            elapsed = time.time() - start
+            num_classified = len({url_topic[0] for url_topic in url_topics})
+            clog.info('Classified %s of %s urls in %.1f seconds (%.1f urls/sec, %.0f%% cache hit rate)',
+                      num_classified, len(urls), elapsed, num_classified / elapsed if elapsed > 0 else 0,
+                      topic_classifier.hit_rate() * 100)
+            if num_classified < CLASSIFY_BATCH_SIZE:
+                time.sleep(CLASSIFY_SLEEP_TIME)
@@ -5,6 +5,7 @@ using the framework contained within this module.
 """
 import anyconfig
 import argparse
+import csv
 import os
 import sys
 import logging
@@ -15,6 +16,8 @@ import chatter.twitter as twitter
 import chatter.usermaintenance as userm
 import chatter.domainmaintenance as dm
 import chatter.urlmaintenance as urlm
+import chatter.classify as classify
+import chatter.topicmodel as topicmodel
 import chatter.urlanalysis as urla
 
 # Set the logger to the package name so this modules logging configuration
@@ -54,6 +57,12 @@ def load_config(config_dir=DEFAULT_CONFIG_DIRECTORY, config_override_file=None):
         # Set the chatter app configurations
         if fconfig.get('domains_to_ignore', None) is not None:
             config.domains_to_ignore = fconfig['domains_to_ignore']
+        if fconfig.get('classifier', None) is not None:
+            config.classifier = fconfig['classifier']
+        if fconfig.get('topic_model_dir', None) is not None:
+            config.topic_model_dir = fconfig['topic_model_dir']
+        if fconfig.get('user_update_hours', None) is not None:
+            config.user_update_hours = fconfig['user_update_hours']
     except Exception as e:
         print('Unable to load configuration file make sure your config.yaml exists and is accessible.')
         print(e)
@@ -93,13 +102,15 @@ CMD_DOMAINS = 'domains'
 CMD_LIST_MAINT = 'listmaint'
 CMD_USER_MAINT = 'usermaint'
 CMD_URL_MAINT = 'urlmaint'
+CMD_CLASSIFY = 'classify'
+CMD_TOPIC_MODEL = 'topicmodel'
 CMD_HOT_URLS = 'hoturls'
 CMD_HOT_URL_SERVICE = 'hoturlservice'
 DESC_KEY = 'desc'
 USAGE_KEY = 'usage'
 CMD_TO_DESC = {
     CMD_GEO_CAPTURE: {DESC_KEY: 'Capture tweets for a given geocode radius',
-                      USAGE_KEY: get_command_usage(CMD_GEO_CAPTURE, 'lat long radius')},
+                      USAGE_KEY: get_command_usage(CMD_GEO_CAPTURE, '(lat long radius | -gf filename)')},
     CMD_LIST_CAPTURE: {DESC_KEY: 'Capture tweets for twitter account lists',
                        USAGE_KEY: get_command_usage(CMD_LIST_CAPTURE, '')},
     CMD_LIST_MAINT: {DESC_KEY: 'Maintain the user account lists',
@@ -110,6 +121,10 @@ CMD_TO_DESC = {
                      USAGE_KEY: get_command_usage(CMD_USER_MAINT)},
     CMD_URL_MAINT: {DESC_KEY: 'Populate metadata for urls of interest',
                     USAGE_KEY: get_command_usage(CMD_URL_MAINT)},
+    CMD_CLASSIFY: {DESC_KEY: 'Classify the topics of urls with metadata',
+                   USAGE_KEY: get_command_usage(CMD_CLASSIFY)},
+    CMD_TOPIC_MODEL: {DESC_KEY: 'Maintain the topic model used to cluster hot lists',
+                      USAGE_KEY: get_command_usage(CMD_TOPIC_MODEL)},
     CMD_DOMAINS: {DESC_KEY: 'Manage the domains of interest',
                   USAGE_KEY: get_command_usage(CMD_DOMAINS, 'filename')},
     CMD_HOT_URLS: {DESC_KEY: 'Create list of hot urls',
@@ -130,6 +145,8 @@ The following chatter commands are available:
     {CMD_LIST_MAINT}      {CMD_TO_DESC[CMD_LIST_MAINT][DESC_KEY]}
     {CMD_USER_MAINT}      {CMD_TO_DESC[CMD_USER_MAINT][DESC_KEY]}
     {CMD_URL_MAINT}       {CMD_TO_DESC[CMD_URL_MAINT][DESC_KEY]}
+    {CMD_CLASSIFY}       {CMD_TO_DESC[CMD_CLASSIFY][DESC_KEY]}
+    {CMD_TOPIC_MODEL}     {CMD_TO_DESC[CMD_TOPIC_MODEL][DESC_KEY]}
     {CMD_DOMAINS}        {CMD_TO_DESC[CMD_DOMAINS][DESC_KEY]}
     {CMD_TWITTER_RL}      {CMD_TO_DESC[CMD_TWITTER_RL][DESC_KEY]}
     {CMD_HOT_URLS}        {CMD_TO_DESC[CMD_HOT_URLS][DESC_KEY]}
@@ -149,12 +166,26 @@ The following chatter commands are available:
         getattr(self, args.command)(get_cmd_parser(args.command))
 
     def geocapture(self, parser):
-        parser.add_argument('lat', type=float, help='The latitude for the tweet epicenter')
-        parser.add_argument('long', type=float, help='The longitude for the tweet epicenter')
-        parser.add_argument('radius', type=int, help='The radius from the epicenter for tweet capture')
+        parser.add_argument('lat', type=float, nargs='?', help='The latitude for the tweet epicenter')
+        parser.add_argument('long', type=float, nargs='?', help='The longitude for the tweet epicenter')
+        parser.add_argument('radius', type=int, nargs='?', help='The radius from the epicenter for tweet capture')
+        parser.add_argument('-gf', dest='geocode_file', type=argparse.FileType('r'),
+                            help='Name of CSV file of lat,long,radius rows to capture together in this process')
         args = parser.parse_args(sys.argv[2:])
+        if args.geocode_file is None and None in (args.lat, args.long, args.radius):
+            parser.error('either lat long radius or a geocode file (-gf) is required')
         process_base_args(args)
-        twitter.capture_geo(args.long, args.lat, args.radius, 0)
+        geo_captures = []
+        if args.lat is not None:
+            geo_captures.append(twitter.GeoCapture(args.lat, args.long, args.radius))
+        if args.geocode_file is not None:
+            with args.geocode_file as file:
+                for row in csv.reader(file):
+                    if len(row) == 0 or row[0].strip().startswith('#'):
+                        continue
+                    lat, long, radius = row
+                    geo_captures.append(twitter.GeoCapture(float(lat), float(long), int(radius)))
+        twitter.capture_geos(geo_captures)
 
     def listcapture(self, parser):
         args = parser.parse_args(sys.argv[2:])
@@ -176,6 +207,16 @@ The following chatter commands are available:
         process_base_args(args)
         urlm.maintain_urls()
 
+    def classify(self, parser):
+        args = parser.parse_args(sys.argv[2:])
+        process_base_args(args)
+        classify.classify_urls()
+
+    def topicmodel(self, parser):
+        args = parser.parse_args(sys.argv[2:])
+        process_base_args(args)
+        topicmodel.maintain_topic_model()
+
     def twitterrl(self, parser):
         parser.add_argument('-ul', dest='user_limits', action='store_true', default=False,
                             help='Flag to get user rate limits instead of app rate limits')
@@ -207,6 +248,8 @@ The following chatter commands are available:
                             help=f'Maximum number of urls/clusters to return (def {urla.DEFAULT_MAX_RESULTS}).')
         parser.add_argument('-c', dest='cluster', default=False, action='store_true',
                             help='Switch to turn on grouping similar urls')
+        parser.add_argument('-m', dest='model', default=urla.DEFAULT_HOTNESS_MODEL, choices=urla.HOTNESS_MODELS,
+                            help=f'Hotness model used to rank urls (def {urla.DEFAULT_HOTNESS_MODEL}).')
         args = parser.parse_args(sys.argv[2:])
         process_base_args(args)
         urla.dump_hot_list(args)
@@ -0,0 +1,133 @@
+"""
+This module groups hot list links that are about the same story.  Each link's title and description is turned into a
+sparse TF-IDF vector, links are compared with a sparse matrix product a block of rows at a time, and links whose cosine
+similarity passes a threshold are joined into the same cluster, along with anything they are in turn joined to.  Links
+that already have dense topic vectors, see chatter.topicmodel, are clustered the same way with cluster_vectors.
+"""
+import logging
+import math
+import time
+from collections import Counter
+from itertools import chain
+
+import numpy as np
+from scipy import sparse
+from scipy.sparse.csgraph import connected_components
+
+import chatter.config as config
+
+clog = logging.getLogger(__name__)
+
+# Links whose TF-IDF vectors have at least this cosine similarity are put in the same cluster
+CLUSTER_SIMILARITY = 0.5
+# Number of links compared against all the others at a time, bounding the memory used for the similarities
+CLUSTER_BLOCK_SIZE = 2000
+
+
+def get_link_texts(links):
+    """Return the list of words in the title and description of each link, leaving out stop words."""
+    word_split = config.get_word_split()
+    stoplist = config.get_cluster_stop_list()
+    texts = []
+    for link in links:
+        doc = ' '.join([x for x in [link.get('title', None), link.get('description', None)] if x is not None])
+        texts.append([word for word in word_split.split(doc.lower()) if word not in stoplist and len(word) > 1])
+    return texts
+
+
+def get_tfidf_matrix(texts):
+    """Return a sparse matrix with a row for each text holding its L2 normalised TF-IDF vector.  Words that only
+    appear once across all the texts can not link two texts together, so they are left out."""
+    counts = Counter(chain.from_iterable(texts))
+    vocabulary = {}
+    for word, count in counts.items():
+        if count > 1:
+            vocabulary[word] = len(vocabulary)
+    rows, cols, values = [], [], []
+    doc_freq = np.zeros(len(vocabulary))
+    for row, text in enumerate(texts):
+        term_counts = Counter(word for word in text if word in vocabulary)
+        for word, count in term_counts.items():
+            col = vocabulary[word]
+            rows.append(row)
+            cols.append(col)
+            values.append(1 + math.log(count))
+            doc_freq[col] += 1
+    matrix = sparse.csr_matrix((values, (rows, cols)), shape=(len(texts), len(vocabulary)), dtype=np.float64)
+    idf = np.log((1 + len(texts)) / (1 + doc_freq)) + 1
+    matrix = matrix @ sparse.diags(idf)
+    norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=1)).ravel())
+    norms[norms == 0] = 1
+    return sparse.csr_matrix(sparse.diags(1 / norms) @ matrix)
+
+
+def get_similar_pairs(matrix, threshold=CLUSTER_SIMILARITY, block_size=CLUSTER_BLOCK_SIZE):
+    """Return a sparse adjacency matrix joining every pair of rows with at least threshold cosine similarity.  The rows
+    must be L2 normalised and may be either a sparse matrix or a dense array."""
+    num_rows = matrix.shape[0]
+    is_sparse = sparse.issparse(matrix)
+    transposed = matrix.T.tocsc() if is_sparse else matrix.T
+    blocks = []
+    for start in range(0, num_rows, block_size):
+        block = matrix[start:start + block_size] @ transposed
+        if is_sparse:
+            block = block.tocoo()
+            keep = block.data >= threshold
+            blocks.append((block.row[keep] + start, block.col[keep]))
+        else:
+            rows, cols = np.nonzero(block >= threshold)
+            blocks.append((rows + start, cols))
+    rows = np.concatenate([block[0] for block in blocks]) if blocks else np.array([], dtype=np.int64)
+    cols = np.concatenate([block[1] for block in blocks]) if blocks else np.array([], dtype=np.int64)
+    return sparse.csr_matrix((np.ones(len(rows), dtype=np.int8), (rows, cols)), shape=(num_rows, num_rows))
+
+
+def cluster_matrix(matrix, threshold=CLUSTER_SIMILARITY):
+    """Return the cluster number of each row, rows joined directly or through other rows share a cluster."""
+    num_clusters, labels = connected_components(get_similar_pairs(matrix, threshold), directed=False)
+    return labels
+
+
+def cluster_vectors(links, vectors, threshold=CLUSTER_SIMILARITY):
+    """Group links about the same story given a dense array of their L2 normalised vectors, one row per link."""
+    if len(links) == 0:
+        return []
+    return group_links(links, cluster_matrix(vectors, threshold))
+
+
+def group_links(links, labels):
+    """Given links and their cluster numbers return the clusters, each sorted hottest link first, in the order of the
+    first link in each."""
+    clusters = {}
+    for link, label in zip(links, labels):
+        clusters.setdefault(label, []).append(link)
+    clusters = list(clusters.values())
+    for cluster in clusters:
+        cluster.sort(key=lambda x: x['hotness'], reverse=True)
+    return clusters
+
+
+def cluster_links(links, threshold=CLUSTER_SIMILARITY):
+    """Group links about the same story, returning a list of clusters of links."""
+    if len(links) == 0:
+        return []
+    return group_links(links, cluster_matrix(get_tfidf_matrix(get_link_texts(links)), threshold))
+
+
+if __name__ == '__main__':
+    # Benchmark clustering synthetic hot lists of increasing size
+    import random
+    logging.basicConfig(level=logging.INFO)
+    random.seed(42)
+    vocabulary = [f'word{i}' for i in range(20000)]
+    for num_links in (100, 1000, 5000, 10000, 20000):
+        # Roughly five links per story, each story sharing most of its words across its links
+        stories = [random.sample(vocabulary, 15) for _ in range(num_links // 5)]
+        links = []
+        for i in range(num_links):
+            story = random.choice(stories)
+            words = random.sample(story, 12) + random.sample(vocabulary, 3)
+            links.append({'title': ' '.join(words[:6]), 'description': ' '.join(words[6:]), 'hotness': random.random()})
+        start = time.time()
+        clusters = cluster_links(links)
+        clog.info('%s links in %s clusters in %.2f seconds', num_links, len(clusters), time.time() - start)
@@ -32,10 +32,15 @@ calais_tag_url = 'https://api.thomsonreuters.com/permid/calais'
 calais_classify_language = 'English'
 
 # Chatter configs that can be over ridden in yaml file
-# Specify domains that should be ignored during tweet capture
+# The topic classifier plugin, 'calais', 'local' or the dotted path of a chatter.classify.Classifier class
+classifier = 'calais'
+# Directory the topic model used for clustering hot lists is saved in, shared by the topicmodel command and hot lists
+topic_model_dir = 'topicmodel'
+# Number of hours since their last update before users are refreshed from Twitter again
+user_update_hours = 24
+# Specify domains that should be ignored during tweet capture, see chatter.domainmatch for the rule formats
 domains_to_ignore = {
-    'twitter.com', 'www.youtube.com' 'www.facebook.com', 'youtu.be',
-    'www.instagram.com'
+    '.twitter.com', '.youtube.com', '.facebook.com', 'youtu.be', '.instagram.com'
 }
 
 # Chatter configs that can only be set in the code here
@@ -51,8 +56,8 @@ def get_cluster_stop_list():
     global _cluster_stop_list
     if _cluster_stop_list is None:
         with open('stoplist.json') as fh:
-            __cluster_stop_list = json.load(fh)
-    return __cluster_stop_list
+            _cluster_stop_list = frozenset(json.load(fh))
+    return _cluster_stop_list
 
 
 _word_split = None
@@ -28,12 +28,13 @@ class CustomTwitterPager(object):
         self.resource = resource
         self.params = params
 
-    def get_iterator(self, wait=5, new_tweets=False, max_iterations=0):
+    def get_iterator(self, wait=0, new_tweets=False, max_iterations=0):
         """Iterate response from Twitter REST API resource. Resource is called
         in a loop to retrieve consecutive pages of results.
 
-        :param wait: Floating point number (default=5) of seconds wait between requests.
-                     Depending on the resource, appropriate values are 5 or 60 seconds.
+        :param wait: Floating point number (default=0) of seconds minimum between requests.
+                     Requests are always paced by the shared rate limiter, so this is
+                     only needed to slow a resource further.
         :param new_tweets: Boolean determining the search direction.
                            False (default) retrieves old results.
                            True retrieves current results.
@@ -47,6 +48,7 @@ class CustomTwitterPager(object):
             try:
                 # get one page of results
                 start = time.time()
+                ct.wait_for_request(self.resource)
                 r = self.api.request(self.resource, self.params)
                 ct.rl_for_request(r, self.resource)
                 num_calls += 1
@@ -118,7 +120,9 @@ class CustomTwitterPager(object):
                     continue
 
             except TwitterRequestError as e:
-                if e.status_code < 500:
+                if e.status_code == 429:
+                    ct.rate_limited(self.resource)
+                elif e.status_code < 500:
                     raise
                 continue
             except TwitterConnectionError:
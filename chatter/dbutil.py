@@ -12,6 +12,13 @@ import chatter.config as config
 
 clog = logging.getLogger(__name__)
 
+# Number of rows sent to the server per multi-row INSERT statement on the bulk ingest path
+BULK_PAGE_SIZE = 1000
+# Number of hours of tweeters kept in the hot url rollup, hot lists reaching further back than this use the raw tables
+HOT_URL_ROLLUP_HOURS = 72
+# The tweeted_urls columns tweets can be picked by when rolling them up into the hot urls
+HOT_URL_MATCH_COLUMNS = ('tu.tweet_id', 'tu.url_hash')
+
 _conn_pool = None
 
 
@@ -19,7 +26,8 @@ _conn_pool = None
 def get_db_connection():
     global _conn_pool
     if _conn_pool is None:
-        _conn_pool = pool.SimpleConnectionPool(
+        # Threaded pool as capture writes happen on a background writer thread
+        _conn_pool = pool.ThreadedConnectionPool(
             host=config.db_host,
             port=config.db_port,
             minconn=config.db_min_conn,
@@ -47,7 +55,26 @@ def get_db_cursor(commit=True):
             cur.close()
 
 
-def execute_many(sql, data):
+@contextmanager
+def transaction():
+    """Yield a cursor on a single pooled connection.  Everything executed with the cursor is committed together when
+    the block exits, or rolled back together if the block raises."""
+    with get_db_connection() as conn:
+        cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+        try:
+            yield cur
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            cur.close()
+
+
+def execute_many(sql, data, cur=None):
+    if cur is not None:
+        cur.executemany(sql, data)
+        return
     with get_db_cursor() as cur:
         try:
             cur.executemany(sql, data)
@@ -57,6 +84,22 @@ def execute_many(sql, data):
             clog.debug(cur.query)
 
 
+def execute_values(sql, data, template=None, cur=None):
+    """Bulk version of execute_many.  The sql must contain a single 'VALUES %s' placeholder, which is expanded into a
+    multi-row VALUES list so that each page of BULK_PAGE_SIZE rows costs a single round trip to the server.  When a
+    cursor from transaction() is passed in, errors are raised so the whole unit of work is rolled back."""
+    if cur is not None:
+        psycopg2.extras.execute_values(cur, sql, data, template=template, page_size=BULK_PAGE_SIZE)
+        return
+    with get_db_cursor() as cur:
+        try:
+            psycopg2.extras.execute_values(cur, sql, data, template=template, page_size=BULK_PAGE_SIZE)
+        except psycopg2.Error as error:
+            clog.exception(f'Error executing sql ({sql}) with data ({data})')
+        finally:
+            clog.debug(cur.query)
+
+
 @contextmanager
 def execute_query(sql, data=None):
     with get_db_cursor() as cur:
@@ -69,40 +112,86 @@ def execute_query(sql, data=None):
             clog.debug(cur.query)
 
 
-def add_tweets(tweets):
+def add_tweets(tweets, cur=None):
     if len(tweets) > 0:
-        sql = "INSERT INTO tweets(tweet_id, text, user_id, created_at, retweeted_tweet_id) VALUES(%s, %s, %s, %s, %s) ON CONFLICT ON CONSTRAINT tweets_pkey DO NOTHING"
-        execute_many(sql, tweets)
+        sql = "INSERT INTO tweets(tweet_id, text, user_id, created_at, retweeted_tweet_id) VALUES %s ON CONFLICT ON CONSTRAINT tweets_pkey DO NOTHING"
+        execute_values(sql, tweets, cur=cur)
 
 
-def add_urls_for_tweet(urls):
+def add_urls_for_tweet(urls, cur=None):
     if len(urls) > 0:
-        sql = "INSERT INTO tweeted_urls(tweet_id, url_hash, url, domain) VALUES(%s, %s, %s, %s) ON CONFLICT ON CONSTRAINT tweeted_urls_pkey DO NOTHING"
-        execute_many(sql, urls)
+        sql = "INSERT INTO tweeted_urls(tweet_id, url_hash, url, domain, real_url, real_url_hash) VALUES %s ON CONFLICT ON CONSTRAINT tweeted_urls_pkey DO NOTHING"
+        execute_values(sql, urls, cur=cur)
+
+
+def get_resolved_urls(url_hashes):
+    """Return the real url of each of the urls url maintenance has resolved.  Urls it gave up on, after a 404 or too
+    many failures, are left resolved to themselves with no url_info, and are not returned so they get tried again."""
+    query = ' '.join(("SELECT DISTINCT ON (url_hash) url_hash, real_url, real_url_hash, domain FROM tweeted_urls tu",
+                      "WHERE url_hash = ANY(%s) AND real_url_hash IS NOT NULL AND (real_url_hash <> url_hash",
+                      "OR EXISTS (SELECT 1 FROM url_info ui WHERE ui.real_url_hash = tu.real_url_hash))"))
+    with execute_query(query, (list(url_hashes),)) as cur:
+        return cur.fetchall()
 
 
-def update_urls_for_tweet(url_metadata):
+def update_urls_for_tweet(url_metadata, cur=None):
     if len(url_metadata) > 0:
         sql = "UPDATE tweeted_urls SET real_url=%s, real_url_hash=%s, domain=%s WHERE url_hash=%s"
-        execute_many(sql, url_metadata)
+        execute_many(sql, url_metadata, cur=cur)
 
 
-def delete_urls_for_tweet(url_hashes):
+def delete_urls_for_tweet(url_hashes, cur=None):
     if len(url_hashes) > 0:
         sql = "DELETE FROM tweeted_urls WHERE url_hash=%s"
-        execute_many(sql, url_hashes)
+        execute_many(sql, url_hashes, cur=cur)
 
 
-def add_hashtags_for_tweets(hashtags):
+def add_hashtags_for_tweets(hashtags, cur=None):
     if len(hashtags) > 0:
-        sql = "INSERT INTO tweeted_hashtags(tweet_id, hashtag) VALUES(%s, %s) ON CONFLICT ON CONSTRAINT tweeted_hashtags_pkey DO NOTHING"
-        execute_many(sql, hashtags)
+        sql = "INSERT INTO tweeted_hashtags(tweet_id, hashtag) VALUES %s ON CONFLICT ON CONSTRAINT tweeted_hashtags_pkey DO NOTHING"
+        execute_values(sql, hashtags, cur=cur)
 
 
-def add_userids_for_tweets(userids):
+def add_userids_for_tweets(userids, cur=None):
     if len(userids) > 0:
-        sql = "INSERT INTO users(user_id, date_added) VALUES(%s, NOW()) ON CONFLICT ON  CONSTRAINT users_pkey DO NOTHING"
-        execute_many(sql, userids)
+        sql = "INSERT INTO users(user_id, date_added) VALUES %s ON CONFLICT ON CONSTRAINT users_pkey DO NOTHING"
+        execute_values(sql, userids, template='(%s, NOW())', cur=cur)
+
+
+def add_capture_batch(tweets, urls, hashtags, userids, checkpoints=()):
+    """Persist one batch of captured tweets and everything hanging off of them in a single transaction, so a failure
+    part way through never leaves urls or hashtags behind without their tweet.  Any capture checkpoints are saved in
+    the same transaction so they never get ahead of the tweets actually stored.  Errors are raised, once logged, so the
+    caller can hold on to the batch and try it again."""
+    # Queue up the urls that still need resolving for url maintenance, the rest can go straight into the hot urls
+    pending_urls = sorted({(url.url_hash, url.url, url.domain) for url in urls if url.real_url_hash is None})
+    resolved_tweet_ids = sorted({url.tweet_id for url in urls if url.real_url_hash is not None})
+    try:
+        with transaction() as cur:
+            add_tweets(tweets, cur)
+            add_urls_for_tweet(urls, cur)
+            add_pending_urls(pending_urls, cur)
+            add_hot_url_tweets('tu.tweet_id', resolved_tweet_ids, cur)
+            add_hashtags_for_tweets(hashtags, cur)
+            add_userids_for_tweets(userids, cur)
+            set_capture_checkpoints(checkpoints, cur)
+    except psycopg2.Error as error:
+        clog.exception(f'Error saving capture batch of {len(tweets)} tweets')
+        raise
+
+
+def get_capture_checkpoints(source):
+    query = "SELECT checkpoint_key, since_id FROM capture_checkpoints WHERE source = %s"
+    with execute_query(query, (source,)) as cur:
+        return {row['checkpoint_key']: row['since_id'] for row in cur.fetchall()}
+
+
+def set_capture_checkpoints(checkpoints, cur=None):
+    if len(checkpoints) > 0:
+        sql = ' '.join(("INSERT INTO capture_checkpoints(source, checkpoint_key, since_id, updated_at) VALUES %s",
+                        "ON CONFLICT ON CONSTRAINT capture_checkpoints_pkey DO UPDATE",
+                        "SET since_id = GREATEST(capture_checkpoints.since_id, EXCLUDED.since_id), updated_at = NOW()"))
+        execute_values(sql, checkpoints, template='(%s, %s, %s, NOW())', cur=cur)
 
 
 def get_userids_needing_list(users_per_fill=100):
@@ -124,8 +213,12 @@ def set_user_list(listid_userid):
         execute_many(sql, listid_userid)
 
 
-def get_userids_to_update(max_ids=100):
-    query = f"SELECT user_id FROM users ORDER BY last_updated ASC NULLS FIRST LIMIT {max_ids}"
+def get_userids_to_update(max_ids=100, min_age_hours=None):
+    """Return the users updated longest ago, only those not updated within min_age_hours if it is given."""
+    where = ''
+    if min_age_hours is not None:
+        where = f"WHERE last_updated IS NULL OR last_updated < NOW() - interval '{int(min_age_hours)} hour'"
+    query = f"SELECT user_id FROM users {where} ORDER BY last_updated ASC NULLS FIRST LIMIT {max_ids}"
     with execute_query(query) as cur:
         return cur.fetchall()
 
@@ -142,17 +235,87 @@ def suspend_users(users):
         execute_many(sql=sql, data=users)
 
 
-def get_urls_needing_metadata(urls_per_fill=100):
-    query = f"SELECT url_hash, url, domain FROM tweeted_urls WHERE real_url_hash IS NULL GROUP BY url_hash, url, domain LIMIT {urls_per_fill}"
-    with execute_query(query) as cur:
+def add_pending_urls(urls, cur=None):
+    """Queue up unresolved urls for url maintenance.  A url that is already queued and waiting out a retry delay is
+    made due again with its attempts reset, as it has just been tweeted again.  A url leased to a worker is left alone,
+    so no other worker can claim it while it is being fetched."""
+    if len(urls) > 0:
+        sql = ' '.join(("INSERT INTO pending_urls(url_hash, url, domain, added_at, next_attempt_at) VALUES %s",
+                        "ON CONFLICT ON CONSTRAINT pending_urls_pkey DO UPDATE",
+                        "SET next_attempt_at = LEAST(pending_urls.next_attempt_at, EXCLUDED.next_attempt_at),",
+                        "attempts = 0",
+                        "WHERE pending_urls.lease_expires IS NULL OR pending_urls.lease_expires < NOW()"))
+        execute_values(sql, urls, template='(%s, %s, %s, NOW(), NOW())', cur=cur)
+
+
+def claim_urls_needing_metadata(worker_id, lease_seconds, urls_per_fill=100):
+    """Lease up to urls_per_fill pending urls that are due to be tried to the worker, longest due first.  Rows already
+    locked by another worker's claim are skipped rather than waited on, and leases that are not given up by
+    complete_pending_urls or retry_pending_urls expire after lease_seconds so a crashed worker's urls get picked up
+    again."""
+    query = ' '.join(("UPDATE pending_urls SET lease_owner = %s, lease_expires = NOW() + interval '1 second' * %s",
+                      "WHERE url_hash IN (SELECT url_hash FROM pending_urls WHERE next_attempt_at <= NOW()",
+                      "AND (lease_expires IS NULL OR lease_expires <= NOW())",
+                      "ORDER BY next_attempt_at LIMIT %s FOR UPDATE SKIP LOCKED)",
+                      "RETURNING url_hash, url, domain, attempts"))
+    with execute_query(query, (worker_id, int(lease_seconds), int(urls_per_fill))) as cur:
         return cur.fetchall()
-        #return [{'url_hash':row[0], 'url':row[1], 'domain':row[2]} for row in rows]
+
+
+def complete_pending_urls(url_hashes, worker_id, cur=None):
+    """Take the urls the worker resolved off the queue, leaving any that were queued again since it leased them."""
+    if len(url_hashes) > 0:
+        sql = "DELETE FROM pending_urls WHERE url_hash = ANY(%s) AND lease_owner = %s"
+        data = (sorted(url_hashes), worker_id)
+        if cur is not None:
+            cur.execute(sql, data)
+        else:
+            with get_db_cursor() as cur:
+                cur.execute(sql, data)
+
+
+def retry_pending_urls(url_hashes, worker_id, retry_seconds, max_retry_seconds, cur=None):
+    """Give up the worker's leases on urls that failed, scheduling each one's next attempt with an exponential
+    backoff of retry_seconds doubled for every earlier failure, capped at max_retry_seconds.  The delay is randomly
+    spread by half either way so urls that failed together are not all retried together."""
+    if len(url_hashes) > 0:
+        sql = ' '.join(("UPDATE pending_urls SET lease_owner = NULL, lease_expires = NULL, attempts = attempts + 1,",
+                        "next_attempt_at = NOW() + interval '1 second' * LEAST(%s, %s * power(2, attempts))",
+                        "* (0.5 + random()) WHERE url_hash = ANY(%s) AND lease_owner = %s"))
+        data = (max_retry_seconds, retry_seconds, list(url_hashes), worker_id)
+        if cur is not None:
+            cur.execute(sql, data)
+        else:
+            with get_db_cursor() as cur:
+                cur.execute(sql, data)
+
+
+def get_url_expansions(url_hashes):
+    if len(url_hashes) == 0:
+        return {}
+    query = "SELECT url_hash, expanded_url FROM url_expansions WHERE url_hash = ANY(%s) AND expires_at > NOW()"
+    with execute_query(query, (list(url_hashes),)) as cur:
+        return {row['url_hash']: row['expanded_url'] for row in cur.fetchall()}
+
+
+def add_url_expansions(url_expansions, ttl_days, cur=None):
+    if len(url_expansions) > 0:
+        sql = ' '.join(("INSERT INTO url_expansions(url_hash, url, expanded_url, expires_at) VALUES %s",
+                        "ON CONFLICT ON CONSTRAINT url_expansions_pkey DO UPDATE",
+                        "SET expanded_url = EXCLUDED.expanded_url, expires_at = EXCLUDED.expires_at"))
+        execute_values(sql, url_expansions, template=f"(%s, %s, %s, NOW() + interval '{int(ttl_days)} day')", cur=cur)
+
+
+def delete_expired_url_expansions():
+    sql = "DELETE FROM url_expansions WHERE expires_at < NOW()"
+    with get_db_cursor() as cur:
+        cur.execute(sql)
 
 
 def add_domains(domains):
     if len(domains) > 0:
-        sql = "INSERT INTO domains(domain_set, domain, subset) VALUES(%s, %s, %s) ON CONFLICT ON CONSTRAINT domains_pkey DO NOTHING"
-        execute_many(sql, domains)
+        sql = "INSERT INTO domains(domain_set, domain, subset) VALUES %s ON CONFLICT ON CONSTRAINT domains_pkey DO NOTHING"
+        execute_values(sql, domains)
 
 
 def remove_all_domains():
@@ -168,28 +331,206 @@ def get_unique_domains():
         return [row['domain'] for row in rows]
 
 
-def add_url_info(url_info):
+def add_url_info(url_info, cur=None):
     if len(url_info) > 0:
-        sql = "INSERT INTO url_info(real_url_hash, title, description) VALUES(%s, %s, %s) ON CONFLICT ON CONSTRAINT url_info_pkey DO NOTHING"
-        execute_many(sql, url_info)
+        sql = "INSERT INTO url_info(real_url_hash, title, description, image_url) VALUES %s ON CONFLICT ON CONSTRAINT url_info_pkey DO NOTHING"
+        execute_values(sql, url_info, cur=cur)
+
+
+def get_classified_urls(max_urls):
+    """Return the title, description and topics of up to max_urls urls that have real topics, to learn from."""
+    query = ' '.join(("SELECT ui.title, ui.description, array_agg(ut.topic) AS topics, array_agg(ut.score) AS scores",
+                      "FROM url_info ui INNER JOIN url_topics ut USING (real_url_hash) WHERE ut.topic <> 'None'",
+                      "GROUP BY ui.real_url_hash, ui.title, ui.description LIMIT %s"))
+    with execute_query(query, (int(max_urls),)) as cur:
+        return cur.fetchall()
 
 
 def get_urls_to_classify(urls_per_fill=100):
+    """Return urls with metadata but no topics, leaving out any the classifier rejected that are not due another try."""
     query = ' '.join(("SELECT ui.real_url_hash, ui.title, ui.description FROM URL_INFO ui",
                      "LEFT OUTER JOIN url_topics ut ON ui.real_url_hash=ut.real_url_hash",
-                     "WHERE ut.real_url_hash IS null LIMIT", str(urls_per_fill)))
+                     "LEFT OUTER JOIN url_classify_failures ucf ON ui.real_url_hash=ucf.real_url_hash",
+                     "WHERE ut.real_url_hash IS null AND (ucf.next_attempt_at IS null OR ucf.next_attempt_at <= NOW())",
+                     "LIMIT", str(urls_per_fill)))
     with execute_query(query) as cur:
         return cur.fetchall()
         #return [{'real_url_hash': row[0], 'title': row[1], 'description': row[2]} for row in rows]
 
 
-def add_url_topics(url_topics):
+def add_url_topics(url_topics, cur=None):
     if len(url_topics) > 0:
-        sql  = "INSERT INTO url_topics(real_url_hash, topic, score) VALUES(%s, %s, %s) ON CONFLICT ON CONSTRAINT url_topics_pkey DO NOTHING"
-        execute_many(sql, url_topics)
+        sql = "INSERT INTO url_topics(real_url_hash, topic, score) VALUES %s ON CONFLICT ON CONSTRAINT url_topics_pkey DO NOTHING"
+        execute_values(sql, url_topics, cur=cur)
+
+
+def add_classify_failures(real_url_hashes, retry_seconds, max_attempts):
+    """Record that the classifier rejected the urls, scheduling each one's next try with an exponential backoff of
+    retry_seconds doubled for every earlier rejection.  Returns the real_url_hash of the urls that have now been
+    rejected max_attempts times."""
+    if len(real_url_hashes) == 0:
+        return []
+    query = ' '.join(("INSERT INTO url_classify_failures(real_url_hash, attempts, next_attempt_at)",
+                      "SELECT real_url_hash, 1, NOW() + interval '1 second' * %s FROM unnest(%s) AS real_url_hash",
+                      "ON CONFLICT ON CONSTRAINT url_classify_failures_pkey DO UPDATE",
+                      "SET attempts = url_classify_failures.attempts + 1, next_attempt_at = NOW() + interval '1 second'",
+                      "* %s * power(2, url_classify_failures.attempts) RETURNING real_url_hash, attempts"))
+    data = (int(retry_seconds), sorted(set(real_url_hashes)), int(retry_seconds))
+    with execute_query(query, data) as cur:
+        return [row['real_url_hash'] for row in cur.fetchall() if row['attempts'] >= max_attempts]
+
+
+def delete_classify_failures(real_url_hashes, cur):
+    if len(real_url_hashes) > 0:
+        cur.execute("DELETE FROM url_classify_failures WHERE real_url_hash = ANY(%s)", (list(real_url_hashes),))
+
+
+def save_url_topics(url_topics):
+    """Store url topics and copy them into the hot urls rollup in a single transaction."""
+    real_url_hashes = sorted({url_topic[0] for url_topic in url_topics})
+    try:
+        with transaction() as cur:
+            add_url_topics(url_topics, cur)
+            update_hot_url_topics(real_url_hashes, cur)
+            delete_classify_failures(real_url_hashes, cur)
+    except psycopg2.Error as error:
+        clog.exception(f'Error saving {len(url_topics)} url topics')
+
+
+def add_hot_url_tweets(match_column, values, cur):
+    """Roll the tweets of resolved urls, picked by tweeted_urls match_column being any of values, up into hot_urls.
+    Each user is only counted once per url, through hot_url_tweeters, so tweets can be rolled up more than once and in
+    any order without being double counted.  Only urls with metadata can be in a hot list, so urls that were not on a
+    valid domain or did not respond are left out.  Rows are written in key order so that capture and url maintenance
+    rolling up the same urls at the same time can not deadlock."""
+    if match_column not in HOT_URL_MATCH_COLUMNS:
+        raise ValueError(f'Can not roll up hot url tweets by {match_column}')
+    if len(values) == 0:
+        return
+    sql = ' '.join(("WITH new_tweets AS (SELECT tu.real_url_hash, MIN(tu.real_url) AS real_url,",
+                    "MIN(tu.domain) AS domain, t.user_id, MIN(t.created_at) AS created_at",
+                    "FROM tweeted_urls tu INNER JOIN tweets t USING (tweet_id)",
+                    f"WHERE {match_column} = ANY(%s) AND tu.real_url_hash IS NOT NULL",
+                    "AND EXISTS (SELECT 1 FROM url_info ui WHERE ui.real_url_hash = tu.real_url_hash)",
+                    "GROUP BY tu.real_url_hash, t.user_id),",
+                    "new_tweeters AS (INSERT INTO hot_url_tweeters(real_url_hash, user_id, first_tweeted)",
+                    "SELECT real_url_hash, user_id, created_at FROM new_tweets ORDER BY real_url_hash, user_id",
+                    "ON CONFLICT ON CONSTRAINT hot_url_tweeters_pkey DO NOTHING RETURNING real_url_hash)",
+                    "INSERT INTO hot_urls(real_url_hash, real_url, domain, total_tweets, first_tweeted, topics)",
+                    "SELECT nt.real_url_hash, MIN(nt.real_url), MIN(nt.domain),",
+                    "(SELECT COUNT(*) FROM new_tweeters ntr WHERE ntr.real_url_hash = nt.real_url_hash),",
+                    "MIN(nt.created_at), array(SELECT array[topic, score::character varying] FROM url_topics ut",
+                    "WHERE ut.real_url_hash = nt.real_url_hash ORDER BY score DESC)",
+                    "FROM new_tweets nt GROUP BY nt.real_url_hash ORDER BY nt.real_url_hash",
+                    "ON CONFLICT ON CONSTRAINT hot_urls_pkey DO UPDATE",
+                    "SET total_tweets = hot_urls.total_tweets + EXCLUDED.total_tweets,",
+                    "first_tweeted = LEAST(hot_urls.first_tweeted, EXCLUDED.first_tweeted)"))
+    cur.execute(sql, (list(values),))
+
+
+def update_hot_url_topics(real_url_hashes, cur):
+    if len(real_url_hashes) > 0:
+        sql = ' '.join(("UPDATE hot_urls hu SET topics = array(SELECT array[topic, score::character varying]",
+                        "FROM url_topics ut WHERE ut.real_url_hash = hu.real_url_hash ORDER BY score DESC)",
+                        "WHERE hu.real_url_hash = ANY(%s)"))
+        cur.execute(sql, (list(real_url_hashes),))
+
+
+def delete_old_hot_url_tweeters(max_age_hours=HOT_URL_ROLLUP_HOURS):
+    """Forget who tweeted urls that are too old to be in a hot list built from the rollup, the counts are kept."""
+    sql = "DELETE FROM hot_url_tweeters WHERE first_tweeted < NOW() - interval '1 hour' * %s"
+    with get_db_cursor() as cur:
+        cur.execute(sql, (int(max_age_hours),))
+
+
+def get_urls_needing_vectors(max_urls, model_version, after_hash=''):
+    """Return the title and description of up to max_urls urls that have no topic vector for model_version or an
+    earlier version yet, in real_url_hash order starting after after_hash.  Vectors stored for a later version, one
+    that failed to be saved, do not count."""
+    query = ' '.join(("SELECT ui.real_url_hash, ui.title, ui.description FROM url_info ui WHERE ui.real_url_hash > %s",
+                      "AND NOT EXISTS (SELECT 1 FROM url_vectors uv WHERE uv.real_url_hash = ui.real_url_hash",
+                      "AND uv.model_version <= %s) ORDER BY ui.real_url_hash LIMIT %s"))
+    with execute_query(query, (after_hash, int(model_version), int(max_urls))) as cur:
+        return cur.fetchall()
+
+
+def get_recent_url_texts(max_age_hours):
+    """Return the title and description of every url in the hot urls rollup first tweeted within max_age_hours."""
+    query = ' '.join(("SELECT real_url_hash, title, description FROM hot_urls INNER JOIN url_info USING (real_url_hash)",
+                      "WHERE first_tweeted > NOW() - interval '1 hour' * %s"))
+    with execute_query(query, (int(max_age_hours),)) as cur:
+        return cur.fetchall()
 
 
-def get_grouped_recently_tweeted_urls(max_age, days_ago, hours_ago):
+def save_url_vectors(url_vectors, keep_versions):
+    """Store (real_url_hash, model_version, vector) rows and drop the vectors of model versions more than keep_versions
+    older than the newest, all in a single transaction.  A url's vector is only dropped if it has one from a newer
+    version, as urls with no vector at all are taken to be new to the model.  Errors are raised so the caller knows the
+    vectors were not stored."""
+    if len(url_vectors) == 0:
+        return
+    newest_version = max(url_vector[1] for url_vector in url_vectors)
+    with transaction() as cur:
+        sql = ' '.join(("INSERT INTO url_vectors(real_url_hash, model_version, vector, updated_at) VALUES %s",
+                        "ON CONFLICT ON CONSTRAINT url_vectors_pkey DO UPDATE",
+                        "SET vector = EXCLUDED.vector, updated_at = EXCLUDED.updated_at"))
+        execute_values(sql, sorted(url_vectors), template='(%s, %s, %s::real[], NOW())', cur=cur)
+        sql = ' '.join(("DELETE FROM url_vectors uv WHERE uv.model_version <= %s",
+                        "AND EXISTS (SELECT 1 FROM url_vectors n",
+                        "WHERE n.real_url_hash = uv.real_url_hash AND n.model_version > uv.model_version)"))
+        cur.execute(sql, (newest_version - keep_versions,))
+
+
+def get_url_vectors(real_url_hashes, model_version):
+    """Return the vector from the given model version of each of real_url_hashes that has one, by real_url_hash."""
+    if len(real_url_hashes) == 0:
+        return {}
+    query = ' '.join(("SELECT real_url_hash, vector FROM url_vectors",
+                      "WHERE real_url_hash = ANY(%s) AND model_version = %s"))
+    with execute_query(query, (list(real_url_hashes), int(model_version))) as cur:
+        return {row['real_url_hash']: row['vector'] for row in cur.fetchall()}
+
+
+def rank_hot_urls(query, data, hotness_sql, limit):
+    """Run a hot list query with each url scored by the hotness_sql expression over its age and total_tweets, returning
+    only the hottest limit urls, hottest first.  A limit of None returns every url."""
+    query = ' '.join((f"SELECT links.*, ({hotness_sql})::double precision AS hotness FROM ({query}) links",
+                      "ORDER BY hotness DESC, total_tweets DESC, age ASC LIMIT %s"))
+    with execute_query(query, data + (limit,)) as cur:
+        return cur.fetchall()
+
+
+def get_hot_urls(max_age, hotness_sql, limit=None):
+    """Return the same rows as get_grouped_recently_tweeted_urls for a hot list ending now, read from the rollup."""
+    query = ' '.join(("SELECT real_url AS url, total_tweets, first_tweeted,",
+                      "(EXTRACT(epoch FROM (AGE(NOW(), first_tweeted)))/3600)::real AS age,",
+                      "real_url_hash AS hash, domain, title, description, topics",
+                      "FROM hot_urls INNER JOIN url_info USING (real_url_hash)",
+                      "WHERE first_tweeted > NOW() - interval '1 hour' * %s AND first_tweeted < NOW()"))
+    return rank_hot_urls(query, (int(max_age),), hotness_sql, limit)
+
+
+def save_url_batch(url_hashes_to_delete, real_url_updates, url_info, url_expansions, expansion_ttl_days,
+                   leased_url_hashes, worker_id, retry_seconds, max_retry_seconds):
+    """Persist the results of a url maintenance batch and take its urls off the pending queue, all in a single
+    transaction so urls are only dequeued once their results are stored."""
+    try:
+        with transaction() as cur:
+            add_url_expansions(url_expansions, expansion_ttl_days, cur)
+            delete_urls_for_tweet(url_hashes_to_delete, cur)
+            update_urls_for_tweet(real_url_updates, cur)
+            add_url_info(url_info, cur)
+            add_hot_url_tweets('tu.url_hash', sorted({update[3] for update in real_url_updates}), cur)
+            # Urls that were resolved or deleted are done with, any others failed and are scheduled to be tried again
+            done = {update[3] for update in real_url_updates} | {url_hash for (url_hash,) in url_hashes_to_delete}
+            complete_pending_urls(done, worker_id, cur)
+            retry_pending_urls(sorted(url_hash for url_hash in leased_url_hashes if url_hash not in done), worker_id,
+                               retry_seconds, max_retry_seconds, cur)
+    except psycopg2.Error as error:
+        clog.exception(f'Error saving url maintenance batch of {len(real_url_updates)} urls')
+
+
+def get_grouped_recently_tweeted_urls(max_age, days_ago, hours_ago, hotness_sql, limit=None):
     query = ' '.join(("select real_url as url, count(distinct t.user_id) as total_tweets, MIN(created_at) as first_tweeted,",
                       "(EXTRACT(epoch from (AGE(NOW() - interval '%s day %s hour', min(created_at))))/3600)::real as age,"
                       "real_url_hash as hash, domain, title, description,"
@@ -197,11 +538,10 @@ def get_grouped_recently_tweeted_urls(max_age, days_ago, hours_ago):
                       "from tweeted_urls tu inner join tweets t using(tweet_id) inner join url_info using(real_url_hash)",
                       "where created_at < now() - interval '%s day %s hour'",
                       "group by real_url, real_url_hash, domain, title, description",
-                      "having AGE(NOW() - interval '%s day %s hour', min(created_at)) < interval '%s hour'",
-                      "order by total_tweets desc, age asc"))
+                      "having AGE(NOW() - interval '%s day %s hour', min(created_at)) < interval '%s hour'"))
     # Psycopg needs these to be strings for them to get encoded right for the query
     days_ago = int(days_ago)
     max_age = int(max_age)
     hours_ago = int(hours_ago)
-    with execute_query(query, (days_ago, hours_ago, days_ago, hours_ago, days_ago, hours_ago, max_age)) as cur:
-        return cur.fetchall()
+    return rank_hot_urls(query, (days_ago, hours_ago, days_ago, hours_ago, days_ago, hours_ago, max_age), hotness_sql,
+                         limit)
@@ -0,0 +1,98 @@
+"""
+This module provides the domain matching used to decide which domains to ignore during capture and which domains are
+of interest during url maintenance.  Domain rules are compiled into a trie of domain labels, read right to left, so a
+lookup costs one dictionary step per label of the host no matter how many rules there are.
+
+Three forms of rule are supported:
+    example.com     matches only example.com
+    *.example.com   matches any subdomain of example.com (www.example.com, m.example.com) but not example.com itself
+    .example.com    matches example.com and any of its subdomains
+"""
+
+_EXACT = '\0exact'
+_SUBDOMAINS = '\0subdomains'
+
+
+def normalize_host(netloc):
+    """Given a url netloc return just the lower cased host name, without any user info, port or trailing dot."""
+    host = netloc.rpartition('@')[2].lower()
+    if host.startswith('['):
+        # IPv6 address literal, the port, if any, follows the closing bracket
+        return host[:host.find(']') + 1]
+    return host.partition(':')[0].rstrip('.')
+
+
+class DomainMatcher:
+
+    def __init__(self, rules=()):
+        self.root = {}
+        self.num_rules = 0
+        for rule in rules:
+            self.add(rule)
+
+    def add(self, rule):
+        rule = rule.strip().lower()
+        markers = [_EXACT]
+        if rule.startswith('*.'):
+            rule = rule[2:]
+            markers = [_SUBDOMAINS]
+        elif rule.startswith('.'):
+            rule = rule[1:]
+            markers = [_EXACT, _SUBDOMAINS]
+        rule = normalize_host(rule)
+        if not rule:
+            return
+        node = self.root
+        for label in reversed(rule.split('.')):
+            node = node.setdefault(label, {})
+        for marker in markers:
+            node[marker] = True
+        self.num_rules += 1
+
+    def matches(self, netloc):
+        """Return True if the host in the given netloc matches any of the rules."""
+        labels = normalize_host(netloc).split('.')
+        node = self.root
+        for i in range(len(labels) - 1, -1, -1):
+            node = node.get(labels[i])
+            if node is None:
+                return False
+            # There are labels left to the left of this one, so the host is a subdomain of this node
+            if i > 0 and _SUBDOMAINS in node:
+                return True
+        return _EXACT in node
+
+    def __contains__(self, netloc):
+        return self.matches(netloc)
+
+    def __len__(self):
+        return self.num_rules
+
+
+if __name__ == '__main__':
+    # Benchmark matching hosts against growing rule sets, compared with checking each rule in turn
+    import random
+    import time
+    random.seed(42)
+    for num_rules in (1000, 100000):
+        domains = [f'site{i}.example{i % 50}.com' for i in range(num_rules)]
+        rules = [random.choice(('', '*.', '.')) + domain for domain in domains]
+        start = time.time()
+        matcher = DomainMatcher(rules)
+        compile_seconds = time.time() - start
+        # About half of the hosts are built from a rule's domain, the rest are not covered by any rule
+        hosts = [random.choice(('www.', 'm.', '')) + (random.choice(domains) if random.random() < 0.5
+                                                     else f'other{random.randrange(num_rules)}.net')
+                 for _ in range(200000)]
+        start = time.time()
+        matched = sum(1 for host in hosts if host in matcher)
+        elapsed = time.time() - start
+        print(f'{num_rules} rules: compiled in {compile_seconds:.2f} seconds, {matched} of {len(hosts)} hosts matched, '
+              f'{len(hosts) / elapsed:.0f} lookups/sec')
+        if num_rules <= 1000:
+            # Checking every rule for each host, as a plain list of suffixes would need
+            suffixes = [rule.lstrip('*') for rule in rules]
+            sample = hosts[:2000]
+            start = time.time()
+            sum(1 for host in sample if any(host == suffix.lstrip('.') or host.endswith(suffix) for suffix in suffixes))
+            print(f'{num_rules} rules: suffix scan {len(sample) / (time.time() - start):.0f} lookups/sec')
@@ -0,0 +1,53 @@
+"""
+This module provides the shared HTTP sessions used for all outbound web requests other than the Twitter API.  Sharing
+a session lets requests to the same host reuse kept alive connections instead of paying for a new TCP and TLS
+handshake every time.  Sessions are created once and can be used from any number of threads.
+"""
+import http.cookiejar
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# Number of hosts to keep connection pools for, and the number of connections kept open to each host
+HTTP_POOL_HOSTS = 100
+HTTP_POOL_CONNECTIONS_PER_HOST = 16
+# Transport level retries for connection failures and gateway errors
+HTTP_RETRIES = 2
+HTTP_RETRY_BACKOFF = 0.3
+HTTP_RETRY_STATUSES = (502, 503, 504)
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+def _create_session(retry):
+    session = requests.Session()
+    # Every request should look like a first visit, cookies are still kept across the redirects of a single request
+    session.cookies.set_policy(http.cookiejar.DefaultCookiePolicy(allowed_domains=[]))
+    adapter = HTTPAdapter(pool_connections=HTTP_POOL_HOSTS, pool_maxsize=HTTP_POOL_CONNECTIONS_PER_HOST,
+                          max_retries=retry)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def _get_session(name, retry):
+    with _sessions_lock:
+        if name not in _sessions:
+            _sessions[name] = _create_session(retry)
+        return _sessions[name]
+
+
+def get_url_session():
+    """Session for fetching tweeted urls, GET requests are safe to retry on read errors and gateway errors too."""
+    return _get_session('urls', Retry(total=HTTP_RETRIES, backoff_factor=HTTP_RETRY_BACKOFF,
+                                      status_forcelist=HTTP_RETRY_STATUSES, raise_on_status=False))
+
+
+def get_calais_session():
+    """Session for the Calais classifier.  Its requests are POSTs, so only failures to connect are retried here, the
+    classifier has its own retry handling for everything else."""
+    return _get_session('calais', Retry(total=HTTP_RETRIES, connect=HTTP_RETRIES, read=0, status=0,
+                                        backoff_factor=HTTP_RETRY_BACKOFF))
@@ -0,0 +1,140 @@
+"""
+This module provides a write-behind buffer between tweet capture and the database.  Capture loops hand their batches
+to an IngestWriter, which persists them on a background thread so a slow database does not stretch the polling
+interval.  The queue is bounded, so if the database falls far enough behind, capture blocks instead of growing
+memory without limit.
+"""
+import logging
+import queue
+import threading
+import time
+
+import chatter.dbutil as db
+from chatter.util import LRUCache
+
+clog = logging.getLogger(__name__)
+
+# Maximum number of batches waiting to be written before capture is made to wait
+INGEST_QUEUE_SIZE = 20
+# Flush the buffered batches to the database once this many tweets are waiting
+INGEST_FLUSH_TWEETS = 1000
+# Flush the buffered batches to the database once the oldest waiting batch is this many seconds old
+INGEST_FLUSH_SECONDS = 5.0
+# Seconds to wait before trying a failed write again, doubled for each further failure up to the maximum.  While the
+# writer is retrying it takes no new batches, so capture is held up once the queue fills rather than losing tweets
+INGEST_RETRY_SECONDS = 1.0
+INGEST_RETRY_MAX_SECONDS = 60.0
+# Number of times the last write is tried when the writer is closed, so a dead database can not stop it exiting
+INGEST_CLOSE_ATTEMPTS = 5
+
+# Number of url_hash -> (real_url, real_url_hash, domain) resolutions kept in memory
+RESOLVED_URL_CACHE_SIZE = 100000
+
+_STOP = object()
+
+_resolved_urls = LRUCache(RESOLVED_URL_CACHE_SIZE)
+
+
+def resolve_known_urls(urls):
+    """Given captured url records return them with the real url filled in for any url that url maintenance has
+    already resolved, so popular links are not queued up to be fetched again every time they are tweeted."""
+    misses = {url.url_hash for url in urls if _resolved_urls.get(url.url_hash) is None}
+    if len(misses) > 0:
+        for row in db.get_resolved_urls(misses):
+            _resolved_urls.put(row['url_hash'], (row['real_url'], row['real_url_hash'], row['domain']))
+    resolved = []
+    num_resolved = 0
+    for url in urls:
+        known = _resolved_urls.get(url.url_hash)
+        if known is None:
+            resolved.append(url)
+        else:
+            num_resolved += 1
+            resolved.append(url._replace(real_url=known[0], real_url_hash=known[1], domain=known[2]))
+    clog.debug('Resolved %s of %s captured urls from previously resolved urls', num_resolved, len(urls))
+    return resolved
+
+
+def persist_batch(tweets, urls, hashtags, userids, checkpoints):
+    """Write a batch of captured tweets, and the capture checkpoints they advance, in a single transaction."""
+    db.add_capture_batch(tweets=tweets, urls=resolve_known_urls(urls), hashtags=hashtags,
+                         userids=[(userid,) for userid in sorted(userids)],
+                         checkpoints=[(source, key, since_id) for (source, key), since_id in checkpoints.items()])
+
+
+class IngestWriter(threading.Thread):
+
+    def __init__(self, queue_size=INGEST_QUEUE_SIZE, flush_tweets=INGEST_FLUSH_TWEETS,
+                 flush_seconds=INGEST_FLUSH_SECONDS):
+        super().__init__(name='chatter-ingest', daemon=True)
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.flush_tweets = flush_tweets
+        self.flush_seconds = flush_seconds
+        self.reset()
+
+    def reset(self):
+        self.tweets = []
+        self.urls = []
+        self.hashtags = []
+        self.userids = set()
+        self.checkpoints = {}
+        self.oldest = None
+
+    def put(self, tweets, urls, hashtags, userids, checkpoints):
+        """Queue a batch for writing, blocking while the queue is full."""
+        self.queue.put((tweets, urls, hashtags, userids, checkpoints))
+
+    def close(self):
+        """Write everything still queued or buffered, then stop the writer thread."""
+        if self.is_alive():
+            self.queue.put(_STOP)
+            self.join()
+
+    def _buffer(self, batch):
+        tweets, urls, hashtags, userids, checkpoints = batch
+        if self.oldest is None:
+            self.oldest = time.time()
+        self.tweets.extend(tweets)
+        self.urls.extend(urls)
+        self.hashtags.extend(hashtags)
+        self.userids.update(userids)
+        for key, since_id in checkpoints.items():
+            self.checkpoints[key] = max(since_id, self.checkpoints.get(key, 0))
+
+    def _flush(self, max_attempts=None):
+        """Write the buffered batches, trying again with a growing delay until it works.  The buffer is only cleared
+        once written, so the tweets and the checkpoints past them are never dropped by a failed write.  With
+        max_attempts the buffer is given up on after that many failed tries."""
+        if self.oldest is None:
+            return
+        clog.debug('Flushing %s buffered tweets to the database', len(self.tweets))
+        attempts = 0
+        while True:
+            attempts += 1
+            try:
+                persist_batch(self.tweets, self.urls, self.hashtags, self.userids, self.checkpoints)
+                break
+            except Exception:
+                clog.exception('Error while writing %s captured tweets, attempt %s', len(self.tweets), attempts)
+                if max_attempts is not None and attempts >= max_attempts:
+                    clog.error('Giving up on writing %s captured tweets', len(self.tweets))
+                    break
+                time.sleep(min(INGEST_RETRY_SECONDS * 2 ** (attempts - 1), INGEST_RETRY_MAX_SECONDS))
+        self.reset()
+
+    def run(self):
+        while True:
+            timeout = None
+            if self.oldest is not None:
+                timeout = max(0.0, self.oldest + self.flush_seconds - time.time())
+            try:
+                batch = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                self._flush()
+                continue
+            if batch is _STOP:
+                self._flush(max_attempts=INGEST_CLOSE_ATTEMPTS)
+                return
+            self._buffer(batch)
+            if len(self.tweets) >= self.flush_tweets or time.time() >= self.oldest + self.flush_seconds:
+                self._flush()
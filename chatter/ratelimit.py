@@ -0,0 +1,98 @@
+"""
+This module paces calls to a rate limited API using the limit information the API returns with each response.  Each
+resource gets a token bucket whose refill rate spreads the requests remaining in the current window evenly over the
+time left before the window resets, keeping a few requests in reserve so the limit itself is never hit.
+"""
+import logging
+import threading
+import time
+
+clog = logging.getLogger(__name__)
+
+# Length of a rate limit window in seconds, used to estimate the next reset when a window rolls over
+RATE_LIMIT_WINDOW = 15 * 60
+# Requests per window held back so requests already in flight never push us over the limit
+RATE_LIMIT_RESERVE = 2
+# Maximum number of requests that can go out back to back after a quiet spell
+RATE_LIMIT_BURST = 3
+
+
+class _Bucket:
+    __slots__ = ('limit', 'remaining', 'reset', 'rate', 'tokens', 'updated')
+
+    def __init__(self, limit, remaining, reset, now):
+        self.limit = limit
+        self.tokens = 1.0
+        self.updated = now
+        self.set_window(remaining, reset, now)
+
+    def set_window(self, remaining, reset, now):
+        self.remaining = remaining
+        self.reset = reset
+        usable = remaining - RATE_LIMIT_RESERVE
+        self.rate = usable / max(reset - now, 1.0) if usable > 0 else 0.0
+        if self.rate == 0.0:
+            self.tokens = 0.0
+
+    def refill(self, now):
+        # Once the window has reset the server will have restored the full limit
+        if now >= self.reset:
+            self.set_window(self.limit, now + RATE_LIMIT_WINDOW, now)
+            self.tokens = max(self.tokens, 1.0)
+        self.tokens = min(RATE_LIMIT_BURST, self.tokens + (self.rate * (now - self.updated)))
+        self.updated = now
+
+    def wait_time(self, now):
+        if self.tokens >= 1.0:
+            return 0.0
+        if self.rate == 0.0:
+            return self.reset - now
+        return (1.0 - self.tokens) / self.rate
+
+
+class RateLimiter:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.buckets = {}
+
+    def acquire(self, resource):
+        """Block until a request may be made against the resource.  Resources we have not heard limits for yet are
+        not paced, the first response will tell us what the limits are."""
+        while True:
+            with self.lock:
+                bucket = self.buckets.get(resource)
+                if bucket is None:
+                    return
+                now = time.time()
+                bucket.refill(now)
+                wait = bucket.wait_time(now)
+                if wait <= 0:
+                    bucket.tokens -= 1.0
+                    bucket.remaining -= 1
+                    return
+            clog.debug('Pacing %s for %.2f seconds', resource, wait)
+            time.sleep(wait)
+
+    def update(self, resource, limit, remaining, reset):
+        """Re-plan the pacing for a resource from the limits reported with a response."""
+        now = time.time()
+        with self.lock:
+            bucket = self.buckets.get(resource)
+            if bucket is None:
+                self.buckets[resource] = _Bucket(limit, remaining, reset, now)
+            else:
+                bucket.refill(now)
+                bucket.limit = limit
+                bucket.set_window(remaining, reset, now)
+
+    def exhausted(self, resource):
+        """Stop requests to the resource until its window resets, for when the API tells us we are over the limit."""
+        now = time.time()
+        with self.lock:
+            bucket = self.buckets.get(resource)
+            if bucket is None:
+                bucket = self.buckets[resource] = _Bucket(0, 0, now + RATE_LIMIT_WINDOW, now)
+            reset = bucket.reset if bucket.reset > now else now + RATE_LIMIT_WINDOW
+            bucket.set_window(0, reset, now)
+            clog.warning('Rate limit reached for %s, pausing until %s', resource, time.ctime(reset))
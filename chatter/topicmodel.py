@@ -0,0 +1,209 @@
+"""
+This module maintains the LSI topic model used to cluster similar stories in the hot lists.  Rather than training a
+model for every hot list, a single model is updated in the background by the topicmodel command as url metadata comes
+in, saved to disk and memory mapped by the processes serving hot lists.  The topic vector of every url is stored in the
+url_vectors table, so clustering a hot list mostly comes down to comparing stored vectors.
+
+Updating the model shifts its topics, so new urls are added to the model in memory and only every so often is a new
+version of it saved.  Before the new version is put in place the vectors of the new urls, and of recently tweeted urls,
+are stored for it, alongside the vectors of the versions hot list processes may still be using.  Vectors are only ever
+compared with vectors of the same version, and a url only counts as having a vector once it has one for the version in
+place or an earlier one.
+"""
+import glob
+import logging
+import os
+import threading
+import time
+
+import gensim
+import numpy as np
+
+import chatter.config as config
+import chatter.dbutil as db
+from chatter.clustering import cluster_links as cluster_links_tfidf, cluster_vectors, get_link_texts
+
+clog = logging.getLogger(__name__)
+
+TOPIC_MODEL_SLEEP_TIME = 30
+# Number of topics in the model, the length of every url vector.  The model covers days of stories rather than a single
+# hot list, so it needs more topics than a model trained per hot list would
+TOPIC_MODEL_TOPICS = 200
+# Words are hashed into this many buckets, so the vocabulary never needs to be known up front or grow
+TOPIC_MODEL_HASH_BUCKETS = 2 ** 17
+# Number of new urls added to the model at a time
+TOPIC_MODEL_BATCH_SIZE = 1000
+# A new version of the model is saved once this many urls have been added to it, or once urls have been waiting this
+# many seconds to be saved, each version is a full copy of the model on disk
+TOPIC_MODEL_SAVE_URLS = 50000
+TOPIC_MODEL_SAVE_SECONDS = 15 * 60
+# Urls first tweeted within this many hours get their vectors projected again whenever the model is updated
+TOPIC_MODEL_REPROJECT_HOURS = db.HOT_URL_ROLLUP_HOURS
+# Number of model versions kept on disk and in url_vectors, so processes still using the previous version can carry on
+TOPIC_MODEL_KEEP_VERSIONS = 2
+# Seconds between checks by hot list processes for a newer model on disk
+TOPIC_MODEL_CHECK_SECONDS = 30
+# Links whose topic vectors have at least this cosine similarity are put in the same cluster
+TOPIC_MODEL_SIMILARITY = 0.8
+CURRENT_VERSION_FILE = 'current'
+
+_model = None
+_model_checked_at = 0
+_model_lock = threading.Lock()
+
+
+class TopicModel:
+
+    def __init__(self, version, lsi):
+        self.version = version
+        self.lsi = lsi
+
+    def get_vectors(self, texts):
+        """Return the L2 normalised topic vector of each list of words as the rows of a dense matrix."""
+        corpus = [self.lsi.id2word.doc2bow(text) for text in texts]
+        vectors = gensim.matutils.corpus2dense(self.lsi[corpus], num_terms=self.lsi.num_topics,
+                                               num_docs=len(corpus)).T
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        norms[norms == 0] = 1
+        return vectors / norms
+
+
+def get_model_path(directory, version):
+    return os.path.join(directory, f'lsi-{version}.model')
+
+
+def load_topic_model(directory, mmap=None):
+    """Return the current TopicModel saved in directory, or None if no model has been saved yet."""
+    try:
+        with open(os.path.join(directory, CURRENT_VERSION_FILE)) as fh:
+            version = int(fh.read().strip())
+    except FileNotFoundError:
+        return None
+    return TopicModel(version, gensim.models.LsiModel.load(get_model_path(directory, version), mmap=mmap))
+
+
+def save_topic_model(directory, model):
+    """Save the model under its version, then point the current version at it.  The projection matrix is saved as a
+    separate file so it can be memory mapped, and the switch to the new version happens in one atomic rename."""
+    os.makedirs(directory, exist_ok=True)
+    model.lsi.save(get_model_path(directory, model.version), separately=['u'])
+    current_tmp = os.path.join(directory, CURRENT_VERSION_FILE + '.tmp')
+    with open(current_tmp, 'w') as fh:
+        fh.write(str(model.version))
+    os.replace(current_tmp, os.path.join(directory, CURRENT_VERSION_FILE))
+    for version in range(1, model.version - TOPIC_MODEL_KEEP_VERSIONS + 1):
+        for path in glob.glob(get_model_path(directory, version) + '*'):
+            os.remove(path)
+
+
+def get_topic_model():
+    """Return the current topic model, memory mapped from disk and checked for a newer version every
+    TOPIC_MODEL_CHECK_SECONDS, or None if there is no model yet."""
+    global _model
+    global _model_checked_at
+    with _model_lock:
+        if time.time() > _model_checked_at + TOPIC_MODEL_CHECK_SECONDS:
+            _model_checked_at = time.time()
+            try:
+                with open(os.path.join(config.topic_model_dir, CURRENT_VERSION_FILE)) as fh:
+                    version = int(fh.read().strip())
+                if _model is None or _model.version != version:
+                    _model = load_topic_model(config.topic_model_dir, mmap='r')
+                    clog.info('Loaded topic model version %s', _model.version)
+            except FileNotFoundError:
+                pass
+            except Exception:
+                clog.exception('Unable to load the topic model')
+        return _model
+
+
+def update_topic_model(model, rows):
+    """Add the title and description of the url_info rows to the model in memory, creating the model if there is none
+    yet.  The model keeps the version it was last saved as, 0 if it has never been saved."""
+    if model is None:
+        dictionary = gensim.corpora.HashDictionary(id_range=TOPIC_MODEL_HASH_BUCKETS, debug=False)
+    else:
+        dictionary = model.lsi.id2word
+    corpus = [dictionary.doc2bow(text) for text in get_link_texts(rows)]
+    if model is None:
+        lsi = gensim.models.LsiModel(corpus=corpus, id2word=dictionary, num_topics=TOPIC_MODEL_TOPICS)
+        return TopicModel(0, lsi)
+    model.lsi.add_documents(corpus)
+    return model
+
+
+def publish_topic_model(model, rows):
+    """Save the model as a new version, given the url_info rows added to it since it was last saved.  The vectors of
+    those urls and of the recently tweeted urls are stored for the new version first, so hot list processes find them
+    as soon as they load it.  If saving the model then fails the version is never put in place, and the urls are still
+    offered by get_urls_needing_vectors.  Returns the model with its new version, or raises if it could not be
+    saved."""
+    new_model = TopicModel(model.version + 1, model.lsi)
+    new_hashes = {row['real_url_hash'] for row in rows}
+    recent = [row for row in db.get_recent_url_texts(TOPIC_MODEL_REPROJECT_HOURS)
+              if row['real_url_hash'] not in new_hashes]
+    rows = rows + recent
+    vectors = new_model.get_vectors(get_link_texts(rows))
+    db.save_url_vectors([(row['real_url_hash'], new_model.version, vector.tolist())
+                         for row, vector in zip(rows, vectors)], TOPIC_MODEL_KEEP_VERSIONS)
+    save_topic_model(config.topic_model_dir, new_model)
+    clog.info('Saved topic model version %s with %s new urls and %s recent urls', new_model.version,
+              len(rows) - len(recent), len(recent))
+    return new_model
+
+
+def maintain_topic_model():
+    """Keep the topic model up to date with new url metadata until stopped."""
+    model = load_topic_model(config.topic_model_dir)
+    if model is not None:
+        clog.info('Continuing from topic model version %s', model.version)
+    # Urls added to the model since it was last saved, they have no vectors yet so the urls needing vectors are paged
+    # through by real_url_hash to keep from adding them again
+    unsaved = []
+    last_hash = ''
+    last_saved = time.time()
+    while True:
+        rows = db.get_urls_needing_vectors(TOPIC_MODEL_BATCH_SIZE, model.version if model is not None else 0,
+                                           last_hash)
+        if len(rows) > 0:
+            start = time.time()
+            model = update_topic_model(model, rows)
+            unsaved.extend(rows)
+            last_hash = rows[-1]['real_url_hash']
+            clog.info('Added %s urls to the topic model in %.1f seconds', len(rows), time.time() - start)
+        save_due = len(unsaved) >= TOPIC_MODEL_SAVE_URLS or time.time() > last_saved + TOPIC_MODEL_SAVE_SECONDS
+        if len(unsaved) > 0 and save_due:
+            try:
+                model = publish_topic_model(model, unsaved)
+                unsaved = []
+                last_hash = ''
+                last_saved = time.time()
+            except Exception:
+                # The urls stay in unsaved, to be saved with the next attempt
+                clog.exception('Unable to save topic model version %s', model.version + 1)
+        if len(rows) < TOPIC_MODEL_BATCH_SIZE:
+            time.sleep(TOPIC_MODEL_SLEEP_TIME)
+
+
+def cluster_links(links):
+    """Group links about the same story using their stored topic vectors.  Links without a vector for the current model
+    are projected with the memory mapped model, and if there is no model at all the links are clustered with TF-IDF
+    instead."""
+    if len(links) == 0:
+        return []
+    model = get_topic_model()
+    if model is None:
+        return cluster_links_tfidf(links)
+    stored = db.get_url_vectors([link['hash'] for link in links], model.version)
+    vectors = np.zeros((len(links), model.lsi.num_topics))
+    missing = []
+    for i, link in enumerate(links):
+        vector = stored.get(link['hash'])
+        if vector is not None:
+            vectors[i] = vector
+        else:
+            missing.append(i)
+    if len(missing) > 0:
+        vectors[missing] = model.get_vectors(get_link_texts([links[i] for i in missing]))
+    clog.debug('Clustering %s links with %s stored topic vectors', len(links), len(links) - len(missing))
+    return cluster_vectors(links, vectors, TOPIC_MODEL_SIMILARITY)
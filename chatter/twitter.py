@@ -1,13 +1,20 @@
 from TwitterAPI import TwitterAPI, TwitterConnectionError, TwitterRequestError, TwitterPager
-from dateutil import parser as date_parser
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import heapq
+import itertools
+import threading
 import time
 import logging
 
 import chatter.dbutil as db
+import chatter.ingest as ingest
+from chatter.ratelimit import RateLimiter
 from chatter.custom_twitter_pager import CustomTwitterPager
 import chatter.config as config
 from chatter.util import get_domain_ignore
 from chatter.util import get_hashed_string
+from chatter.util import parse_twitter_timestamp
 from chatter.util import should_continue
 
 clog = logging.getLogger(__name__)
@@ -21,16 +28,40 @@ R_LISTS_OWNERSHIPS = 'lists/ownerships'
 R_LISTS_CREATE = 'lists/create'
 R_LISTS_MEMBERS_CREATE_ALL = 'lists/members/create_all'
 R_USERS_LOOKUP = 'users/lookup'
-GEO_PAUSE = 2.2
+# Polling is paced by the rate limiter, these only back off geo polling while no new tweets are showing up
+GEO_IDLE_BACKOFF = 2.2
+MAX_CAPTURE_SLEEP_TIME = 30
+# Seconds to wait before polling a geocode again after an error, doubled for each further error in a row up to the max
+GEO_ERROR_SLEEP_TIME = 5
+MAX_GEO_ERROR_SLEEP_TIME = 5 * 60
 GEO_COUNT = 100
-LIST_PAUSE = 1.0
 LIST_COUNT = 200
-MAX_CAPTURE_SLEEP_TIME = 30
+# Number of lists that are polled at the same time
+LIST_WORKERS = 4
+# Busy lists are polled at most this often and quiet lists at least this often, in seconds
+LIST_MIN_INTERVAL = 15
+LIST_MAX_INTERVAL = 300
+# Weight given to the latest poll when updating a list's tweet volume
+LIST_VOLUME_DECAY = 0.5
+# How often to pick up new lists from the database, in seconds
+LIST_REFRESH_TIME = 60*60
 MAX_REQUEST_TRIES = 3
 REQUEST_RETRY_SLEEP_TIME = 3
+# Sources for the since_id checkpoints saved with each capture batch
+CHECKPOINT_GEO = 'geo'
+CHECKPOINT_LIST = 'list'
 
 _app_api = None
 _user_api = None
+_api_lock = threading.Lock()
+# Shared by every request we make so all callers of a resource draw from the same rate limit budget
+_rate_limiter = RateLimiter()
+
+# Compact records for the rows captured from each tweet, these are plain tuples so they can be handed to the db as is
+TweetRecord = namedtuple('TweetRecord', ['tweet_id', 'text', 'user_id', 'created_at', 'retweeted_tweet_id'])
+UrlRecord = namedtuple('UrlRecord', ['tweet_id', 'url_hash', 'url', 'domain', 'real_url', 'real_url_hash'],
+                       defaults=(None, None))
+HashtagRecord = namedtuple('HashtagRecord', ['tweet_id', 'hashtag'])
 
 
 class TweetCaptureDataset:
@@ -44,13 +75,25 @@ class TweetCaptureDataset:
         self.mentions = []
         self.hashtags = []
         self.userids = set()
+        self.checkpoints = {}
+        # The same links get tweeted over and over, so remember (url_hash, domain) or None if ignored for each url
+        self.parsed_urls = {}
+
+    def set_checkpoint(self, source, key, since_id):
+        """Record the newest tweet id read for a capture source, to be saved along with this dataset."""
+        self.checkpoints[(source, key)] = since_id
 
     def _add_url(self, tweet_id, url):
-        parsed_result, ignore_domain = get_domain_ignore(url)
-        if ignore_domain:
+        try:
+            parsed = self.parsed_urls[url]
+        except KeyError:
+            parsed_result, ignore_domain = get_domain_ignore(url)
+            parsed = None if ignore_domain else (get_hashed_string(url), parsed_result.netloc)
+            self.parsed_urls[url] = parsed
+        if parsed is None:
             return False
         else:
-            self.urls.append((tweet_id, get_hashed_string(url), url, parsed_result.netloc))
+            self.urls.append(UrlRecord(tweet_id, parsed[0], url, parsed[1]))
             return True
 
     def add_tweet(self, tweet):
@@ -71,61 +114,118 @@ class TweetCaptureDataset:
             retweeted_id = None
             if 'retweeted_status' in tweet:
                 retweeted_id = tweet['retweeted_status']['id_str']
-            self.tweets.append((tweet_id, tweet['text'], tweet['user']['id'],
-                                str(date_parser.parse(tweet['created_at'])), retweeted_id))
-            self.userids.add(tweet['user']['id'])
-            self.hashtags.extend([(tweet_id, x['text']) for x in tweet['entities']['hashtags']])
-
-    def save(self):
-        if len(self.tweets) > 0:
-            clog.info("Adding %s new tweets", len(self.tweets))
-            db.add_tweets(self.tweets)
-            # We don't need to do a len check for url's as the current addTweet rules do not capture the tweet unless
-            # there are valid urls in the tweet
-            db.add_urls_for_tweet(self.urls)
-            db.add_hashtags_for_tweets(self.hashtags)
-            db.add_userids_for_tweets([(userid,) for userid in self.userids])
+            user_id = tweet['user']['id']
+            self.tweets.append(TweetRecord(tweet_id, tweet['text'], user_id,
+                                           parse_twitter_timestamp(tweet['created_at']), retweeted_id))
+            self.userids.add(user_id)
+            self.hashtags.extend([HashtagRecord(tweet_id, x['text']) for x in tweet['entities']['hashtags']])
+
+    def save(self, writer=None):
+        """Persist the captured tweets and checkpoints, handing them to the background writer if one is given.
+        Returns True if there were tweets to save."""
+        has_tweets = len(self.tweets) > 0
+        if has_tweets or len(self.checkpoints) > 0:
+            if has_tweets:
+                clog.info("Adding %s new tweets", len(self.tweets))
+            if writer is None:
+                ingest.persist_batch(self.tweets, self.urls, self.hashtags, self.userids, self.checkpoints)
+            else:
+                writer.put(self.tweets, self.urls, self.hashtags, self.userids, self.checkpoints)
             self.reset()
-            return True
-        else:
-            return False
+        return has_tweets
+
 
+class ListScheduler:
+    """Decides which list should be polled next.  Each list is due again after an interval that shrinks as its recent
+    tweet volume grows, so busy lists are revisited often and quiet ones only occasionally.  The rate limiter paces
+    the actual requests, so when the lists/statuses budget is tight the lists that are furthest overdue go first."""
 
-class ListInfo:
     def __init__(self):
-        self.pointer = 0
+        self.lock = threading.Lock()
+        self.lists = {}
+        self.due = []
+        # Each time a list is scheduled it gets a new generation, any older heap entries for it are stale and dropped
+        self.generations = itertools.count()
         self.update_from_db()
 
+    def _schedule(self, list_id, due):
+        generation = next(self.generations)
+        self.lists[list_id]['generation'] = generation
+        heapq.heappush(self.due, (due, generation, list_id))
+
     def update_from_db(self):
-        lists = db.get_listids_to_count()
-        self.lists = [x['list_id'] for x in lists]
-        self.last_updated = time.time()
+        list_ids = [x['list_id'] for x in db.get_listids_to_count()]
+        checkpoints = db.get_capture_checkpoints(CHECKPOINT_LIST)
+        now = time.time()
+        with self.lock:
+            for list_id in list_ids:
+                if list_id not in self.lists:
+                    self.lists[list_id] = {'latest_tweet_id': checkpoints.get(list_id, 0), 'volume': 0.0,
+                                           'last_polled': None}
+                    self._schedule(list_id, now)
+            for list_id in set(self.lists) - set(list_ids):
+                del self.lists[list_id]
+        self.last_updated = now
 
     def get_next_list(self):
-        out = self.lists[self.pointer]
-        self.pointer += 1
-        if self.pointer >= len(self.lists):
-            self.pointer = 0
-            if time.time() > (self.last_updated + 60*60):
+        """Block until a list is due, then return the list id and the latest tweet id seen for it.  The list is not
+        handed out again until complete_list is called for it."""
+        while True:
+            if time.time() > (self.last_updated + LIST_REFRESH_TIME):
                 self.update_from_db()
-        return out
+            with self.lock:
+                if self.due:
+                    due, generation, list_id = self.due[0]
+                    now = time.time()
+                    if due <= now:
+                        heapq.heappop(self.due)
+                        if list_id not in self.lists or self.lists[list_id]['generation'] != generation:
+                            continue
+                        return list_id, self.lists[list_id]['latest_tweet_id']
+                    wait = due - now
+                else:
+                    wait = LIST_MIN_INTERVAL
+            time.sleep(wait)
+
+    def complete_list(self, list_id, latest_tweet_id, num_tweets):
+        """Record the outcome of polling a list and schedule its next poll based on its tweet volume."""
+        now = time.time()
+        with self.lock:
+            if list_id not in self.lists:
+                return
+            state = self.lists[list_id]
+            if state['last_polled'] is None:
+                # The first poll picks up a backlog of tweets from an unknown stretch of time, which says nothing about
+                # the list's volume, so poll again soon to take a first real measurement
+                interval = LIST_MIN_INTERVAL
+            else:
+                minutes = max(now - state['last_polled'], 1) / 60
+                state['volume'] = (((1 - LIST_VOLUME_DECAY) * state['volume']) +
+                                   (LIST_VOLUME_DECAY * num_tweets / minutes))
+                interval = min(max(LIST_MAX_INTERVAL / (1 + state['volume']), LIST_MIN_INTERVAL), LIST_MAX_INTERVAL)
+            state['latest_tweet_id'] = max(state['latest_tweet_id'], latest_tweet_id)
+            state['last_polled'] = now
+            self._schedule(list_id, now + interval)
+            clog.debug('List %s volume %.2f tweets/min next poll in %.1f seconds', list_id, state['volume'], interval)
 
 
 def _get_api(app_auth=True):
     global _app_api
     global _user_api
-    if app_auth:
-        if _app_api is None:
-            _app_api = TwitterAPI(consumer_key=config.twitter_consumer_key,
-                                  consumer_secret=config.twitter_consumer_secret, auth_type='oAuth2')
-        return _app_api
-    else:
-        if _user_api is None:
-            _user_api = TwitterAPI(consumer_key=config.twitter_consumer_key,
-                                   consumer_secret=config.twitter_consumer_secret,
-                                   access_token_key=config.twitter_access_token_key,
-                                   access_token_secret=config.twitter_access_token_secret)
-        return _user_api
+    # List capture calls this from several worker threads, so make sure only one client of each type gets created
+    with _api_lock:
+        if app_auth:
+            if _app_api is None:
+                _app_api = TwitterAPI(consumer_key=config.twitter_consumer_key,
+                                      consumer_secret=config.twitter_consumer_secret, auth_type='oAuth2')
+            return _app_api
+        else:
+            if _user_api is None:
+                _user_api = TwitterAPI(consumer_key=config.twitter_consumer_key,
+                                       consumer_secret=config.twitter_consumer_secret,
+                                       access_token_key=config.twitter_access_token_key,
+                                       access_token_secret=config.twitter_access_token_secret)
+            return _user_api
 
 
 def _api_request(resource, params=None, method_override=None, app_auth=True):
@@ -134,8 +234,16 @@ def _api_request(resource, params=None, method_override=None, app_auth=True):
     while num_tries < MAX_REQUEST_TRIES:
         num_tries += 1
         try:
+            _rate_limiter.acquire(resource)
             r = _get_api(app_auth).request(resource=resource, params=params, method_override=method_override)
             rl_for_request(resource=resource, request=r)
+            if r.status_code == 429:
+                # TwitterAPI hands back a rate limited response rather than raising.  Our pacing should keep us from
+                # getting here, but if it does wait for the window to reset before trying again
+                rate_limited(resource)
+                if num_tries < MAX_REQUEST_TRIES:
+                    continue
+                raise TwitterRequestError(r.status_code)
             return r
         except TwitterRequestError as tre:
             if tre.status_code < 500:
@@ -172,11 +280,23 @@ def rl_for_request(request, resource=''):
         limits = {'limit': request.headers[HEADER_RATE_LIMIT], 'remaining': request.headers[HEADER_LIMIT_REMAINING],
                   'reset': request.headers[HEADER_LIMIT_RESET]}
         clog.debug('%s - %s', resource, limits)
+        _rate_limiter.update(resource, limit=int(limits['limit']), remaining=int(limits['remaining']),
+                             reset=int(limits['reset']))
     else:
         clog.debug('No rate limit info in header for resource %s', resource)
     return limits
 
 
+def wait_for_request(resource):
+    """Block until the rate limit for the resource allows another request."""
+    _rate_limiter.acquire(resource)
+
+
+def rate_limited(resource):
+    """Record that Twitter rejected a request to the resource for exceeding its rate limit."""
+    _rate_limiter.exhausted(resource)
+
+
 def get_rate_limit_status(user_limits=False):
     r = _api_request(resource='application/rate_limit_status', params={'resources': 'search,lists'},
                      app_auth=(not user_limits))
@@ -218,36 +338,88 @@ def add_users_to_list(list_name, users):
     _api_request(resource=R_LISTS_MEMBERS_CREATE_ALL, params=params, app_auth=False)
 
 
+class GeoCapture:
+    """The capture state for a single geocode.  Each geocode keeps its own since_id and idle backoff so many of them
+    can be polled from one process."""
+
+    def __init__(self, lat, long, radius, since_id=0):
+        self.geocode = f'{lat},{long},{radius}mi'
+        self.since_id = since_id
+        self.sleep_time = 0
+        self.next_poll = 0
+        self.errors = 0
+
+    def poll(self, writer):
+        params = {'geocode': self.geocode, 'result_type': 'recent', 'count': GEO_COUNT, 'since_id': self.since_id}
+        pager = CustomTwitterPager(_get_api(), 'search/tweets', params=params)
+        tcd = TweetCaptureDataset()
+        had_tweet = False
+        for tweet in pager.get_iterator(wait=0, new_tweets=True, max_iterations=3):
+            had_tweet = True
+            if tweet['id'] > self.since_id:
+                self.since_id = tweet['id']
+            tcd.add_tweet(tweet)
+        if had_tweet:
+            tcd.set_checkpoint(CHECKPOINT_GEO, self.geocode, self.since_id)
+            if not tcd.save(writer):
+                clog.info('No new relevant Geo tweets for %s', self.geocode)
+            self.sleep_time = 0
+        else:  # If we did not have any tweets begin the backoff of calling the API
+            self.sleep_time += GEO_IDLE_BACKOFF
+            if self.sleep_time > MAX_CAPTURE_SLEEP_TIME:
+                self.sleep_time = MAX_CAPTURE_SLEEP_TIME
+            clog.info('No new tweets for geo %s setting sleep time to: %f', self.geocode, self.sleep_time)
+        self.errors = 0
+        self.next_poll = time.time() + self.sleep_time
+
+    def failed(self):
+        """Push the next poll back after an error, further for each error in a row, so a failing geocode is not
+        retried straight away."""
+        self.errors += 1
+        error_sleep_time = min(GEO_ERROR_SLEEP_TIME * 2 ** (self.errors - 1), MAX_GEO_ERROR_SLEEP_TIME)
+        clog.info('Error number %s for geo %s setting sleep time to: %f', self.errors, self.geocode, error_sleep_time)
+        self.next_poll = time.time() + error_sleep_time
+
+
 def capture_geo(long, lat, radius, since_id):
-    sleep_time = GEO_PAUSE
-    params = {'geocode': f'{lat},{long},{radius}mi', 'result_type': 'recent', 'count': GEO_COUNT, 'since_id': since_id}
-    while True:
+    capture_geos([GeoCapture(lat, long, radius, since_id)])
+
+
+def capture_geos(geo_captures):
+    """Capture tweets for any number of geocodes from one process, sharing the API client, the database pool and the
+    search/tweets rate limit budget between them."""
+    writer = ingest.IngestWriter()
+    writer.start()
+    try:
+        _capture_geos(geo_captures, writer)
+    finally:
+        writer.close()
+
+
+def _capture_geos(geo_captures, writer):
+    # Pick up where a previous run of these geocodes left off
+    checkpoints = db.get_capture_checkpoints(CHECKPOINT_GEO)
+    for geo_capture in geo_captures:
+        geo_capture.since_id = max(geo_capture.since_id, checkpoints.get(geo_capture.geocode, 0))
+    # Order by next poll time, the index breaks ties so GeoCapture objects never get compared
+    due = [(0, i) for i in range(len(geo_captures))]
+    while due:
+        next_poll, i = heapq.heappop(due)
+        geo_capture = geo_captures[i]
+        wait = next_poll - time.time()
+        if wait > 0:
+            time.sleep(wait)
         try:
-            pager = CustomTwitterPager(_get_api(), 'search/tweets', params=params)
-            tcd = TweetCaptureDataset()
-            had_tweet = False
-            for tweet in pager.get_iterator(wait=GEO_PAUSE, new_tweets=True, max_iterations=3):
-                had_tweet = True
-                if tweet['id'] > since_id:
-                    params['since_id'] = tweet['id']
-                tcd.add_tweet(tweet)
-            if had_tweet:
-                if not tcd.save():
-                    clog.info('No new relevant Geo tweets')
-                sleep_time = GEO_PAUSE
-            else:  # If we did not have any tweets begin the backoff of calling the API
-                sleep_time += GEO_PAUSE
-                if sleep_time > MAX_CAPTURE_SLEEP_TIME:
-                    sleep_time = MAX_CAPTURE_SLEEP_TIME
-                clog.info('No new tweets for geo setting sleep time to: %f', sleep_time)
+            geo_capture.poll(writer)
         except Exception as e:
-            clog.exception("Error while trying to capture tweets for geo location")
+            clog.exception("Error while trying to capture tweets for geo location %s", geo_capture.geocode)
             if config.exit_on_error:
                 return
-        time.sleep(sleep_time)
+            geo_capture.failed()
+        heapq.heappush(due, (geo_capture.next_poll, i))
 
 
-def capture_list(list_name, latest_tweet_id=0):
+def capture_list(list_name, latest_tweet_id=0, writer=None):
     params = {'slug': list_name, 'owner_screen_name': config.twitter_screen_name, 'count': LIST_COUNT}
     max_iterations = 0
     # If we don't have a maximum tweet id then we only want to process the current LIST_COUNT of tweets
@@ -256,30 +428,69 @@ def capture_list(list_name, latest_tweet_id=0):
     pager = CustomTwitterPager(_get_api(app_auth=False), 'lists/statuses', params=params)
     tcd = TweetCaptureDataset()
     max_tweet_id = latest_tweet_id
-    for tweet in pager.get_iterator(wait=1, new_tweets=False, max_iterations=max_iterations):
+    num_tweets = 0
+    saved = False
+    for tweet in pager.get_iterator(wait=0, new_tweets=False, max_iterations=max_iterations):
         tweet_id = tweet['id']
         if tweet_id and (tweet_id > latest_tweet_id):
+            num_tweets += 1
             tcd.add_tweet(tweet)
             if tweet_id > max_tweet_id:
                 max_tweet_id = tweet_id
+            # Hand off long paginations as we go so they don't build up in memory before being saved
+            if len(tcd.tweets) >= ingest.INGEST_FLUSH_TWEETS:
+                saved = tcd.save(writer)
         else:
             break
-    if not tcd.save():
+    if max_tweet_id > latest_tweet_id:
+        tcd.set_checkpoint(CHECKPOINT_LIST, list_name, max_tweet_id)
+    if not (tcd.save(writer) or saved):
         clog.info('No new relevant tweets for list: %s', list_name)
-    return max_tweet_id
+    return max_tweet_id, num_tweets
 
 
 def capture_user_lists():
-    list_info = ListInfo()
-    latest_tweet_by_list = {}
-    while True:
+    writer = ingest.IngestWriter()
+    writer.start()
+    try:
+        _capture_user_lists(writer)
+    finally:
+        writer.close()
+
+
+def _capture_user_lists(writer):
+    scheduler = ListScheduler()
+    # Limit the lists in flight to the number of workers so a list is only picked once a worker is free to poll it
+    free_workers = threading.Semaphore(LIST_WORKERS)
+    failed = threading.Event()
+
+    def poll_list(list_id, latest_tweet_id):
+        max_tweet_id, num_tweets = latest_tweet_id, 0
         try:
-            list_id = list_info.get_next_list()
-            latest_tweet_by_list[list_id] = capture_list(list_id, latest_tweet_by_list.get(list_id, 0))
+            max_tweet_id, num_tweets = capture_list(list_id, latest_tweet_id, writer)
         except Exception as e:
-            clog.exception("Error while trying to capture tweets for lists")
+            clog.exception("Error while trying to capture tweets for list %s", list_id)
             if config.exit_on_error:
-                return
+                failed.set()
+        finally:
+            scheduler.complete_list(list_id, max_tweet_id, num_tweets)
+            free_workers.release()
+
+    with ThreadPoolExecutor(max_workers=LIST_WORKERS, thread_name_prefix='chatter-list') as executor:
+        while not failed.is_set():
+            free_workers.acquire()
+            if failed.is_set():
+                break
+            try:
+                list_id, latest_tweet_id = scheduler.get_next_list()
+            except Exception as e:
+                free_workers.release()
+                clog.exception("Error while trying to capture tweets for lists")
+                if config.exit_on_error:
+                    break
+                time.sleep(LIST_MIN_INTERVAL)
+                continue
+            executor.submit(poll_list, list_id, latest_tweet_id)
 
 
 # This is a sample for how to use the streaming api, but it is more limiting in the results so we are not using now
@@ -4,14 +4,15 @@ over a given time period.  Support for generating the hotlist as a JSON file via
 is provided.  With the rest service a simple HTML format can be provided also for easy browser viewing.
 """
 import logging
-import gensim
 import json
+import threading
 import time
 import datetime
+from collections import namedtuple
 from flask import Flask, request, render_template, Response
 
 import chatter.dbutil as db
-import chatter.config as config
+from chatter.topicmodel import cluster_links
 from chatter.util import get_int_default_or_max
 
 clog = logging.getLogger(__name__)
@@ -26,6 +27,17 @@ DEFAULT_JSON = False
 DEFAULT_MAX_RESULTS = 50
 # The true max results we will ever return for the service
 MAX_RESULTS_FOR_SERVICE = 100
+# Seconds a generated hot list is served from the cache as is, and the further seconds it may still be served while a
+# fresh one is generated in the background
+HOT_LIST_CACHE_TTL = 15
+HOT_LIST_CACHE_MAX_STALE = 300
+# How quickly urls sink in the gravity hotness model, the higher the gravity the faster older urls fall away
+HOTNESS_GRAVITY = 1.8
+
+# A way of scoring how hot a url is from its age in hours and the number of users that tweeted it.  The sql is an
+# expression over the age and total_tweets columns of the hot list query, so urls can be ranked by the database, and
+# score does the same in python for scoring clusters of urls.
+HotnessModel = namedtuple('HotnessModel', ['name', 'sql', 'score'])
 
 
 class HotListConfig:
@@ -38,37 +50,86 @@ class HotListConfig:
                                                   MAX_RESULTS_FOR_SERVICE)
         self.cluster = args.get('cluster', DEFAULT_CLUSTER)
         self.json = args.get('json', DEFAULT_JSON)
-
-
-def get_cluster_links(links):
-    docs = [' '.join([x for x in [link.get('title', None), link.get('description', None)] if x is not None])
-            for link in links]
-
-    word_split = config.get_word_split()
-    stoplist = config.get_cluster_stop_list()
-    texts = [[word for word in word_split.split(document.lower()) if word not in stoplist and len(word) > 1]
-             for document in docs]
-    all_tokens = sum(texts, [])
-    tokens_once = set(word for word in set(all_tokens) if all_tokens.count(word) == 1)
-    texts = [[word for word in text if word not in tokens_once] for text in texts]
-
-    dictionary = gensim.corpora.Dictionary(texts)
-    lsi = gensim.models.LsiModel(corpus=[dictionary.doc2bow(text) for text in texts], id2word=dictionary, num_topics=50)
-
-    index = gensim.similarities.MatrixSimilarity(lsi[[dictionary.doc2bow(text) for text in texts]])
-
-    ids = set(range(len(texts)))
-    clusters = []
-    while len(ids) > 0:
-        text_id = min(ids)
-        text = texts[text_id]
-        cluster_ids = [x[0] for x in enumerate(index[lsi[dictionary.doc2bow(text)]]) if x[1] > .8 or x[0] == text_id]
-        cluster_links = [links[x] for x in cluster_ids if x in ids]
-        cluster_links.sort(key=lambda x: x['hotness'], reverse=True)
-        if len(cluster_links) > 0:
-            clusters.append(cluster_links)
-        ids.difference_update(cluster_ids)
-    return clusters
+        self.model = args.get('model', DEFAULT_HOTNESS_MODEL)
+        if self.model not in HOTNESS_MODELS:
+            self.model = DEFAULT_HOTNESS_MODEL
+
+    def cache_key(self):
+        """Return the settings that determine the content of the hot list, the output format does not matter."""
+        return self.days_ago, self.hours_ago, self.age, self.max_results, bool(self.cluster), self.model
+
+
+class HotListCache:
+    """Cache of generated hot lists.  A list is served as is for ttl seconds, then for up to max_stale more seconds
+    the old list is still served while a single background thread generates a fresh one.  Past that, requests wait
+    for the list to be generated, with only one of them doing the generating for any one key."""
+
+    def __init__(self, ttl=HOT_LIST_CACHE_TTL, max_stale=HOT_LIST_CACHE_MAX_STALE):
+        self.ttl = ttl
+        self.max_stale = max_stale
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.in_flight = {}
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.refreshes = 0
+
+    def get(self, hlc):
+        key = hlc.cache_key()
+        with self.lock:
+            now = time.time()
+            generated_at, hot_list = self.entries.get(key, (0, None))
+            if now < generated_at + self.ttl:
+                self.hits += 1
+                return hot_list
+            if now < generated_at + self.ttl + self.max_stale:
+                self.stale_hits += 1
+                if key not in self.in_flight:
+                    self.in_flight[key] = threading.Event()
+                    threading.Thread(target=self._refresh_quietly, args=(key, hlc), daemon=True).start()
+                return hot_list
+            self.misses += 1
+            done = self.in_flight.get(key)
+            if done is None:
+                self.in_flight[key] = threading.Event()
+        if done is None:
+            return self._refresh(key, hlc)
+        done.wait()
+        with self.lock:
+            generated_at, hot_list = self.entries.get(key, (0, None))
+        # If the request we waited on failed to generate the list have a go ourselves
+        return hot_list if hot_list is not None else gen_hot_list(hlc)
+
+    def _refresh(self, key, hlc):
+        try:
+            hot_list = gen_hot_list(hlc)
+            with self.lock:
+                self.refreshes += 1
+                now = time.time()
+                # Drop anything too old to ever be served again, so the cache only holds recently requested lists
+                self.entries = {k: v for k, v in self.entries.items() if now < v[0] + self.ttl + self.max_stale}
+                self.entries[key] = (now, hot_list)
+            return hot_list
+        finally:
+            with self.lock:
+                self.in_flight.pop(key).set()
+
+    def _refresh_quietly(self, key, hlc):
+        try:
+            self._refresh(key, hlc)
+        except Exception:
+            clog.exception('Error refreshing cached hot list')
+
+    def stats(self):
+        with self.lock:
+            requests = self.hits + self.stale_hits + self.misses
+            return {'hits': self.hits, 'stale_hits': self.stale_hits, 'misses': self.misses,
+                    'refreshes': self.refreshes, 'cached_lists': len(self.entries),
+                    'hit_rate': round((self.hits + self.stale_hits) / requests, 4) if requests > 0 else 0}
+
+
+_hot_list_cache = HotListCache()
 
 
 def calculate_hotness(age_in_hours, num_tweets):
@@ -86,37 +147,55 @@ def calculate_hotness(age_in_hours, num_tweets):
     return round((multiplier * num_tweets), 8)
 
 
-def calc_popularity_hotness(tweets, age, opts):
-    popularity_factor = float((tweets-2)*int(opts.popularity_weight))
-    age_factor = float(age * age)
-    if opts.ignore_age:
-        hotness = popularity_factor
-    else:
-        hotness = popularity_factor / age_factor
-    return hotness
+def calculate_gravity_hotness(age_in_hours, num_tweeters):
+    return round((num_tweeters - 1) / (age_in_hours + 2) ** HOTNESS_GRAVITY, 8)
 
 
-def cluster_hotness(cluster):
+def calculate_popularity_hotness(age_in_hours, num_tweets):
+    return float(num_tweets)
+
+
+HOTNESS_MODELS = {model.name: model for model in (
+    # The original model, tweets count for less as the url ages, in steps
+    HotnessModel('age', ' '.join(("round(((CASE WHEN age < 4 THEN 1.20 ELSE 1.05 END - LEAST(age / 24.0, 1.0))",
+                                  "* total_tweets)::numeric, 8)")), calculate_hotness),
+    # Tweeters count for less and less the older the url gets, as on Hacker News.  total_tweets is the number of distinct
+    # users who tweeted the url, and the first of them is not counted just as Hacker News does not count the submitter
+    HotnessModel('gravity', f'round(((total_tweets - 1) / power(age + 2, {HOTNESS_GRAVITY}))::numeric, 8)',
+                 calculate_gravity_hotness),
+    # Just the number of tweeters, age only breaks ties
+    HotnessModel('popularity', 'total_tweets', calculate_popularity_hotness),
+)}
+DEFAULT_HOTNESS_MODEL = 'age'
+
+
+def cluster_hotness(cluster, model):
     age = max([link['age'] for link in cluster])
     tweets = sum([link['total_tweets'] for link in cluster])
-    return calculate_hotness(age, tweets)
+    return model.score(age, tweets)
 
 
 def gen_hot_list(hlc):
     start_time = time.time()
-    links = db.get_grouped_recently_tweeted_urls(max_age=hlc.age, days_ago=hlc.days_ago, hours_ago=hlc.hours_ago)
+    model = HOTNESS_MODELS[hlc.model]
+    # Clusters are built from every url, otherwise only the hottest urls need to come back from the database
+    limit = None if hlc.cluster else int(hlc.max_results)
+    if hlc.days_ago == 0 and hlc.hours_ago == 0 and hlc.age <= db.HOT_URL_ROLLUP_HOURS:
+        # A hot list ending now can be read straight from the incrementally maintained rollup
+        links = db.get_hot_urls(max_age=hlc.age, hotness_sql=model.sql, limit=limit)
+    else:
+        links = db.get_grouped_recently_tweeted_urls(max_age=hlc.age, days_ago=hlc.days_ago, hours_ago=hlc.hours_ago,
+                                                     hotness_sql=model.sql, limit=limit)
     hot_list = {'generated_at': datetime.datetime.utcnow().isoformat() + "Z"}
     if len(links) > 0:
         for link in links:
-            link['hotness'] = calculate_hotness(link['age'], link['total_tweets'])
             link['first_tweeted'] = link['first_tweeted'].isoformat() + 'Z'
         if hlc.cluster:
-            clusters = get_cluster_links(links)
-            clusters.sort(key=cluster_hotness, reverse=True)
+            clusters = cluster_links(links)
+            clusters.sort(key=lambda cluster: cluster_hotness(cluster, model), reverse=True)
             hot_list['clusters'] = clusters[:int(hlc.max_results)]
         else:
-            links.sort(key=lambda x: x['hotness'], reverse=True)
-            hot_list['articles'] = links[:int(hlc.max_results)]
+            hot_list['articles'] = links
     else:
         hot_list['message'] = "No links to process for specified parameters"
 
@@ -132,7 +211,7 @@ def dump_hot_list(hlc):
 
 def hot_list_request():
     hlc = HotListConfig(request.args)
-    hl = gen_hot_list(hlc)
+    hl = _hot_list_cache.get(hlc)
     if hlc.json:
         hl = json.dumps(hl, indent=1)
         r = Response(hl, mimetype='application/json', status=200)
@@ -141,7 +220,12 @@ def hot_list_request():
         return render_template('hotlist.html', hotlist=hl)
 
 
+def hot_list_stats_request():
+    return Response(json.dumps(_hot_list_cache.stats(), indent=1), mimetype='application/json', status=200)
+
+
 def hot_list_service():
     app = Flask('chatter')
     app.add_url_rule(rule='/', endpoint='hotlist', view_func=hot_list_request)
+    app.add_url_rule(rule='/stats', endpoint='stats', view_func=hot_list_stats_request)
     app.run(debug=True)
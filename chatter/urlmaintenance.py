@@ -1,37 +1,130 @@
 """
 This module provides all functionality related to maintaining the url information for chatter.
 """
+import codecs
 import logging
-import requests
+import os
+import re
+import socket
+import threading
 import time
-from collections import Counter
-from bs4 import BeautifulSoup
+from collections import Counter, defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from html.parser import HTMLParser
+from urllib.parse import urlparse
 
 import chatter.dbutil as db
 import chatter.config as config
-from chatter.classifier_calais import ClassifierCalais
+from chatter.domainmatch import DomainMatcher, normalize_host
+from chatter.httpsession import get_url_session
 from chatter.util import get_domain_ignore, get_hashed_string, cleanse_parse_result
 
 clog = logging.getLogger(__name__)
 
-CLASSIFY_SLEEP_TIME = .75
 URL_MAINTENANCE_SLEEP_TIME = 15
+# Seconds between clearing out expired tiny url expansions and hot url tweeters too old for the rollup
+URL_PRUNE_SECONDS = 15 * 60
+# Maximum number of urls being fetched at the same time
+URL_WORKERS = 16
+# Maximum number of urls being fetched from the same domain at the same time
+URL_WORKERS_PER_DOMAIN = 4
+# Minimum number of seconds between starting two requests to the same domain
+URL_DOMAIN_DELAY = 0.25
+# Number of days to remember where a tiny url redirects to
+URL_EXPANSION_TTL_DAYS = 30
+# Number of urls claimed by a url maintenance process at a time, and how long it has to finish them before its claim
+# expires and another process may take them over
+URLS_PER_CLAIM = 100
+URL_LEASE_SECONDS = 600
+# Delay before retrying a url that failed, doubled for each further failure up to the maximum
+URL_RETRY_SECONDS = 60
+URL_RETRY_MAX_SECONDS = 6 * 60 * 60
+# Page metadata is read in chunks of this size, giving up if the end of the <head> is not found within the byte limit
+METADATA_CHUNK_SIZE = 16 * 1024
+METADATA_MAX_BYTES = 256 * 1024
+META_CHARSET_RE = re.compile(rb'<meta[^>]+charset=["\']?([\w-]+)', re.IGNORECASE)
+
+
+class DomainThrottle:
+    """Per domain concurrency and politeness limits shared by the url workers, so a burst of links to one site never
+    hammers it and a few slow sites can only tie up a few of the workers."""
+
+    def __init__(self, max_per_domain=URL_WORKERS_PER_DOMAIN, delay=URL_DOMAIN_DELAY):
+        self.max_per_domain = max_per_domain
+        self.delay = delay
+        self.cond = threading.Condition()
+        self.active = Counter()
+        self.last_start = {}
+
+    @contextmanager
+    def limit(self, domain):
+        with self.cond:
+            while True:
+                now = time.time()
+                wait = self.last_start.get(domain, 0) + self.delay - now
+                if self.active[domain] < self.max_per_domain and wait <= 0:
+                    break
+                self.cond.wait(timeout=wait if wait > 0 else None)
+            self.active[domain] += 1
+            self.last_start[domain] = now
+            if len(self.last_start) > 1000:
+                self.last_start = {d: t for d, t in self.last_start.items() if t > now - self.delay}
+        try:
+            yield
+        finally:
+            with self.cond:
+                self.active[domain] -= 1
+                if self.active[domain] <= 0:
+                    del self.active[domain]
+                self.cond.notify_all()
 
 
 class UrlMetadataDataset:
 
     def __init__(self):
         self.reset()
-        self.request_fails = Counter()
-        self.classifier = ClassifierCalais()
+        self.throttle = DomainThrottle()
 
     def reset(self):
         self.url_info = []
-        self.url_topics = []
         self.real_url_updates = []
         self.url_hashes_to_delete = []
+        self.url_expansions = {}
+        self.new_url_expansions = []
+
+    def process_urls(self, t_urls, valid_domains, executor):
+        """Process a batch of urls concurrently on the executor, returning once they are all done.  The batch is
+        interleaved by domain, the domain a tiny url is already known to expand to where there is one, so the workers
+        are spread across as many domains as possible."""
+        # Load any known tiny url expansions for the batch up front with a single query
+        self.url_expansions = db.get_url_expansions([t_url['url_hash'] for t_url in t_urls
+                                                     if len(t_url['url']) < config.max_tiny_url_length])
+        by_domain = defaultdict(deque)
+        for t_url in t_urls:
+            expanded_url = self.url_expansions.get(t_url['url_hash'])
+            domain = urlparse(expanded_url).netloc if expanded_url is not None else t_url['domain']
+            by_domain[normalize_host(domain)].append(t_url)
+        ordered = []
+        while by_domain:
+            for domain in list(by_domain):
+                ordered.append(by_domain[domain].popleft())
+                if not by_domain[domain]:
+                    del by_domain[domain]
+        futures = [executor.submit(self._try_process_url, t_url, valid_domains) for t_url in ordered]
+        for future in futures:
+            future.result()
+
+    def _try_process_url(self, t_url, valid_domains):
+        try:
+            self.process_url(t_url, valid_domains)
+        except Exception as e:
+            clog.exception('Unexpected error processing url %s', t_url['url'])
 
     def process_url(self, t_url, valid_domains):
+        # This may run on several worker threads at once, the result lists are only ever appended to, which is
+        # thread safe.  Each request is throttled on the domain it goes to, so the page of a tiny url counts against
+        # the site it expands to rather than the shortener
         url = t_url['url']
         url_hash = t_url['url_hash']
         # Set the real url info to the current info, for cases when we don't need to do a tiny url lookup to
@@ -39,75 +132,169 @@ class UrlMetadataDataset:
         real_url = url
         real_url_hash = url_hash
         domain = t_url['domain']
-        if (domain in valid_domains) or (len(url) < config.max_tiny_url_length):
+        if valid_domains.matches(domain) or (len(url) < config.max_tiny_url_length):
+            r = None
             try:
-                # Requests not only gets the content but follows any redirects (tiny url resolutions) for us so we
-                # get the real url in the end
-                r = requests.get(url, timeout=4)
-                parse_results, ignore_domain = get_domain_ignore(r.url)
+                fetch_url = url
+                status_code = None
+                if not valid_domains.matches(domain):
+                    # A tiny url, find out where it goes before deciding whether the page is worth downloading
+                    fetch_url, status_code = self.expand_short_url(url, url_hash, domain)
+                parse_results, ignore_domain = get_domain_ignore(fetch_url)
                 domain = parse_results.netloc
+                metadata = None
+                if not ignore_domain and status_code != 404 and valid_domains.matches(domain):
+                    with self.throttle.limit(normalize_host(domain)):
+                        # Requests not only gets the content but follows any redirects for us so we get the real url
+                        # in the end
+                        r = get_url_session().get(fetch_url, timeout=4, stream=True)
+                        status_code = r.status_code
+                        parse_results, ignore_domain = get_domain_ignore(r.url)
+                        domain = parse_results.netloc
+                        if not ignore_domain and status_code != 404 and valid_domains.matches(domain):
+                            metadata = get_url_metadata(r)
                 # This could happen if the ignore domains has changed since url capture, or more likely
                 # when a tiny url gets expanded the real domain is discovered and is not valid
                 if ignore_domain:
                     # We delete these as they are known to be not desired
-                    clog.debug('This is a domain to ignore: %s', r.url)
+                    clog.debug('This is a domain to ignore: %s', parse_results.geturl())
                     self.url_hashes_to_delete.append((url_hash,))
-                elif r.status_code == 404:
-                    clog.debug('This URL responds with a 404 status: %s', r.url)
+                elif status_code == 404:
+                    clog.debug('This URL responds with a 404 status: %s', parse_results.geturl())
                 else:
                     # Now that we know we have the true full URL strip the known tracking info so we don't duplicate
                     # url info
                     parse_results = cleanse_parse_result(parse_results)
                     real_url = parse_results.geturl()
                     real_url_hash = get_hashed_string(real_url)
-                    if domain in valid_domains:
+                    if metadata is not None:
                         clog.info('Valid domain: %s', real_url)
-                        desc, title = get_url_metadata(r)
-                        # Do the get topics first so if it fails we don't end up with 2 entries in the url_info list
-                        self.get_topics(real_url_hash, title, desc)
-                        self.url_info.append((real_url_hash, title, desc))
+                        desc, title, image_url = metadata
+                        self.url_info.append((real_url_hash, title, desc, image_url))
             except Exception as e:
                 clog.debug(e)
-                self.request_fails.update([url_hash])
-                clog.info('Fail number %s for url %s', self.request_fails[url_hash], real_url)
-                # If we are going to allow more tries for this url, then return now
-                if self.request_fails[url_hash] < config.url_maintenance_request_retries:
+                num_fails = t_url.get('attempts', 0) + 1
+                clog.info('Fail number %s for url %s', num_fails, real_url)
+                # If we are going to allow more tries for this url, then return now and it is scheduled for a retry
+                if num_fails < config.url_maintenance_request_retries:
                     clog.error(e)
                     return
+            finally:
+                # The page is streamed, so make sure its connection goes back to the pool even if it was never read
+                if r is not None:
+                    r.close()
         else:
             clog.debug('Not a valid domain: %s', real_url)
-        # If this is a url with a previous failed request attempt remove the failed attempt tracking for the url
-        # now that we had a successful call go through
-        if url_hash in self.request_fails:
-            del self.request_fails[url_hash]
         self.real_url_updates.append((real_url, real_url_hash, domain, url_hash))
 
-    def get_topics(self, real_url_hash, title, desc):
-        topics = self.classifier.classify(title, desc)
-        if len(topics) == 0:
-            self.url_topics.append((real_url_hash, 'None', 1))
-        else:
-            for topic in topics:
-                self.url_topics.append((real_url_hash, topic['topic'], topic['score']))
+    def expand_short_url(self, url, url_hash, domain):
+        """Follow the redirects of a tiny url on the given domain without downloading any page, returning the url it
+        ends up at and the final status code, or None for the status if the expansion was already known."""
+        expanded_url = self.url_expansions.get(url_hash)
+        if expanded_url is not None:
+            return expanded_url, None
+        session = get_url_session()
+        with self.throttle.limit(normalize_host(domain)):
+            r = session.head(url, allow_redirects=True, timeout=4)
+            if r.status_code >= 400:
+                # Some servers refuse HEAD requests, a streamed GET follows the same redirects and is closed without
+                # reading the body
+                with session.get(url, stream=True, timeout=4) as r:
+                    pass
+        if r.status_code < 400:
+            self.new_url_expansions.append((url_hash, url, r.url))
+        return r.url, r.status_code
+
+    def save(self, leased_url_hashes=(), worker_id=None):
+        """Store everything gathered since the last reset.  Any of the given leased urls that did not get resolved are
+        scheduled to be retried, in the same transaction."""
+        db.save_url_batch(self.url_hashes_to_delete, self.real_url_updates, self.url_info,
+                          self.new_url_expansions, URL_EXPANSION_TTL_DAYS, leased_url_hashes, worker_id,
+                          URL_RETRY_SECONDS, URL_RETRY_MAX_SECONDS)
+
+
+class HeadMetadataParser(HTMLParser):
+    """Event based parser that picks the title, description and Open Graph tags out of a page's <head> and flags when
+    the head is over, so the rest of the page never needs to be read."""
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.done = False
+        self.in_title = False
+        self.title_parts = []
+        self.meta = {}
+
+    def handle_starttag(self, tag, attrs):
+        if tag == 'title':
+            self.in_title = True
+        elif tag == 'meta':
+            attrs = dict(attrs)
+            key = (attrs.get('property') or attrs.get('name') or '').lower()
+            if key in ('description', 'og:title', 'og:description', 'og:image') and attrs.get('content'):
+                self.meta.setdefault(key, attrs['content'].strip())
+        elif tag == 'body':
+            self.done = True
+
+    def handle_endtag(self, tag):
+        if tag == 'title':
+            self.in_title = False
+        elif tag == 'head':
+            self.done = True
+
+    def handle_data(self, data):
+        if self.in_title:
+            self.title_parts.append(data)
 
-    def save(self):
-        db.delete_urls_for_tweet(self.url_hashes_to_delete)
-        db.update_urls_for_tweet(self.real_url_updates)
-        db.add_url_info(self.url_info)
-        db.add_url_topics(self.url_topics)
+    @property
+    def title(self):
+        title = ''.join(self.title_parts).strip()
+        return title or self.meta.get('og:title')
+
+    @property
+    def description(self):
+        return self.meta.get('description') or self.meta.get('og:description')
+
+    @property
+    def image_url(self):
+        return self.meta.get('og:image')
+
+
+def _get_encoding(r, first_chunk):
+    encoding = None
+    if 'charset' in r.headers.get('content-type', '').lower():
+        encoding = r.encoding
+    else:
+        # Requests falls back to ISO-8859-1 for text without a charset header, look for a meta charset instead
+        match = META_CHARSET_RE.search(first_chunk)
+        if match:
+            encoding = match.group(1).decode('ascii')
+    try:
+        return codecs.getincrementaldecoder(encoding or 'utf-8')(errors='replace')
+    except LookupError:
+        return codecs.getincrementaldecoder('utf-8')(errors='replace')
 
 
 def get_url_metadata(r):
-    tree = BeautifulSoup(r.content, "lxml")
-    title = tree.title.string
+    """Given a streamed response return the page description, title and image url, reading no more of the page than
+    it takes to get through the <head>."""
+    parser = HeadMetadataParser()
+    decoder = None
+    bytes_read = 0
+    try:
+        for chunk in r.iter_content(chunk_size=METADATA_CHUNK_SIZE):
+            if decoder is None:
+                decoder = _get_encoding(r, chunk)
+            bytes_read += len(chunk)
+            parser.feed(decoder.decode(chunk))
+            if parser.done or bytes_read >= METADATA_MAX_BYTES:
+                break
+    finally:
+        r.close()
+    title = parser.title
     clog.debug("Page Title: %s", title)
-    description = tree.find('meta', attrs={'name': 'description'})
-    if description:
-        description = description['content']
-    else:
-        description = None
+    description = parser.description
     clog.debug("Page Description: %s", description)
-    return description, title
+    return description, title, parser.image_url
 
 
 def print_request_headers(r):
@@ -115,28 +302,70 @@ def print_request_headers(r):
         clog.error(f'{hkey}:{hvalue}')
 
 
+def get_worker_id():
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+
 def maintain_urls():
+    """Resolve urls until stopped.  Any number of these can run at once, on one or many hosts, each claims its own
+    batches of urls so no url is fetched by two of them."""
     # Need to occasionally refresh this so we pick up any changes, right now it requires restarting the process
-    valid_domains = set(db.get_unique_domains())
+    valid_domains = DomainMatcher(db.get_unique_domains())
     umd = UrlMetadataDataset()
-    while True:
-        t_urls = db.get_urls_needing_metadata()
-        for t_url in t_urls:
-            umd.process_url(t_url, valid_domains)
-        umd.save()
-        umd.reset()
-        clog.info('Processed %s urls', len(t_urls))
-        if len(t_urls) < 50:
-            time.sleep(URL_MAINTENANCE_SLEEP_TIME)
+    worker_id = get_worker_id()
+    clog.info('Maintaining urls as worker %s', worker_id)
+    last_pruned = 0
+    with ThreadPoolExecutor(max_workers=URL_WORKERS, thread_name_prefix='chatter-url') as executor:
+        while True:
+            t_urls = db.claim_urls_needing_metadata(worker_id, URL_LEASE_SECONDS, URLS_PER_CLAIM)
+            start = time.time()
+            umd.process_urls(t_urls, valid_domains, executor)
+            umd.save([t_url['url_hash'] for t_url in t_urls], worker_id)
+            umd.reset()
+            elapsed = time.time() - start
+            clog.info('Processed %s urls in %.1f seconds (%.1f urls/sec)', len(t_urls), elapsed,
+                      len(t_urls) / elapsed if elapsed > 0 else 0)
+            # Pruned on a timer rather than when idle, so the tables still get pruned while there is a backlog of urls
+            if time.time() > last_pruned + URL_PRUNE_SECONDS:
+                db.delete_expired_url_expansions()
+                db.delete_old_hot_url_tweeters()
+                last_pruned = time.time()
+            if len(t_urls) < 50:
+                time.sleep(URL_MAINTENANCE_SLEEP_TIME)
 
 
-def classify_urls():
-    umd = UrlMetadataDataset()
-    while True:
-        urls_to_classify = db.get_urls_to_classify(5)
-        for url in urls_to_classify:
-            umd.get_topics(url['real_url_hash'], url['title'], url['description'])
-        clog.info(umd.url_topics)
-        umd.save()
-        umd.reset()
-        time.sleep(CLASSIFY_SLEEP_TIME)
+if __name__ == '__main__':
+    # Benchmark pulling the metadata out of synthetic news pages of 0.5-2MB, served from memory in streamed chunks
+    import random
+
+    class _PageResponse:
+
+        def __init__(self, content):
+            self.content = content
+            self.headers = {'content-type': 'text/html; charset=utf-8'}
+            self.encoding = 'utf-8'
+
+        def iter_content(self, chunk_size=1):
+            for i in range(0, len(self.content), chunk_size):
+                yield self.content[i:i + chunk_size]
+
+        def close(self):
+            pass
+
+    logging.basicConfig(level=logging.INFO)
+    random.seed(42)
+    pages = []
+    for i in range(10):
+        head = ''.join(('<head><meta charset="utf-8"><title>Story number ', str(i), '</title>',
+                        '<meta name="description" content="What happened in story ', str(i), '">',
+                        '<meta property="og:image" content="https://example.com/', str(i), '.jpg">',
+                        '<script>var x = 1;</script>' * 200, '</head>'))
+        paragraphs = ''.join(f'<p>Paragraph {n} of the story with <a href="/link{n}">a link</a>.</p>'
+                             for n in range(random.randrange(8000, 32000)))
+        pages.append(f'<!DOCTYPE html><html>{head}<body>{paragraphs}</body></html>'.encode('utf-8'))
+    start = time.time()
+    for page in pages:
+        get_url_metadata(_PageResponse(page))
+    elapsed = time.time() - start
+    clog.info('Read metadata from %s pages, %.1fMB in all, in %.3f seconds, %.0f pages/sec', len(pages),
+              sum(len(page) for page in pages) / 2 ** 20, elapsed, len(pages) / elapsed)
@@ -4,6 +4,7 @@ This module provides all functionality related to maintaining the user informati
 import logging
 import time
 
+import chatter.config as config
 import chatter.dbutil as db
 import chatter.twitter as twitter
 
@@ -14,7 +15,8 @@ LIST_SLEEP_TIME = 15
 MAX_USERS_PER_LIST = 4999
 MAX_USERS_PER_DAY = 1000
 NUM_SECONDS_FOR_REST_PERIOD = 86400
-
+# When no users are due for a refresh wait this many seconds before looking again, how long users go between refreshes
+# is set by config.user_update_hours
 USER_SLEEP_TIME = 5
 
 
@@ -70,11 +72,15 @@ def maintain_lists():
 
 
 def maintain_users():
-    ids = db.get_userids_to_update()
-    if len(ids) == 0:  # This will only happen in a new system that hasn't started tweet capture yet
-        clog.error("No users to update, make sure you have ran a tweet capture job!")
-        return
+    ids = db.get_userids_to_update(min_age_hours=config.user_update_hours)
     while True:
+        if len(ids) == 0:
+            # Everyone has been refreshed recently, or tweet capture has not found any users yet, so don't spend the
+            # users/lookup budget looking them up again
+            clog.debug("No users due for a refresh")
+            time.sleep(USER_SLEEP_TIME)
+            ids = db.get_userids_to_update(min_age_hours=config.user_update_hours)
+            continue
         uids = [row['user_id'] for row in ids]
         uid_string = ",".join(map(str, uids))
         response = twitter.get_info_for_users(uid_string)
@@ -92,6 +98,6 @@ def maintain_users():
                 user_suspensions.append((uid,))
         db.update_user_data(user_updates)
         db.suspend_users(user_suspensions)
-        time.sleep(USER_SLEEP_TIME)
+        # No sleep needed here, the users/lookup requests are paced by the Twitter rate limiter
         # Get the next set of users ids to process
-        ids = db.get_userids_to_update()
+        ids = db.get_userids_to_update(min_age_hours=config.user_update_hours)
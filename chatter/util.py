@@ -2,15 +2,21 @@
 This module is a catch all for utility functions that may be needed throughout chatter
 """
 import logging
+import threading
 import time
 import hashlib
+from collections import OrderedDict
 from urllib.parse import urlparse, parse_qsl, urlencode
+from dateutil import parser as date_parser
 
 import chatter.config as config
+from chatter.domainmatch import DomainMatcher
 
 clog = logging.getLogger(__name__)
 
 CLEANSE_PREFIXES = ('utm_', 'fbclid', 'gclid', 'trk_')
+TWITTER_MONTHS = {'Jan': '01', 'Feb': '02', 'Mar': '03', 'Apr': '04', 'May': '05', 'Jun': '06',
+                  'Jul': '07', 'Aug': '08', 'Sep': '09', 'Oct': '10', 'Nov': '11', 'Dec': '12'}
 
 
 def cleanse_parse_result(p_url):
@@ -24,13 +30,24 @@ def cleanse_parse_result(p_url):
     return p_url._replace(query=urlencode(cleansed_qp_list))
 
 
+_ignore_matcher = None
+_ignore_matcher_rules = None
+
+
+def get_ignore_matcher():
+    """Return the DomainMatcher for config.domains_to_ignore, recompiling it if the configured domains are replaced."""
+    global _ignore_matcher
+    global _ignore_matcher_rules
+    if _ignore_matcher_rules is not config.domains_to_ignore:
+        _ignore_matcher = DomainMatcher(config.domains_to_ignore)
+        _ignore_matcher_rules = config.domains_to_ignore
+    return _ignore_matcher
+
+
 def get_domain_ignore(url):
     """Given a url return the urllib.parse.ParseResult, and a boolean set to True if this domain should be ignored."""
     p_url = urlparse(url)
-    should_ignore = False
-    if p_url.netloc in config.domains_to_ignore:
-        should_ignore = True
-    return p_url, should_ignore
+    return p_url, get_ignore_matcher().matches(p_url.netloc)
 
 
 def get_hashed_string(s):
@@ -38,6 +55,16 @@ def get_hashed_string(s):
     return hashlib.sha1(s.encode('utf-8')).hexdigest()
 
 
+def parse_twitter_timestamp(created_at):
+    """Given a Twitter created_at string (ex. 'Wed Oct 10 20:19:24 +0000 2018') return it as the ISO formatted string
+    we store.  Twitter always uses this fixed UTC format, so it is sliced apart directly and dateutil is only used for
+    anything unexpected."""
+    parts = created_at.split(' ')
+    if len(parts) == 6 and parts[4] == '+0000' and parts[1] in TWITTER_MONTHS and len(parts[2]) == 2:
+        return f'{parts[5]}-{TWITTER_MONTHS[parts[1]]}-{parts[2]} {parts[3]}+00:00'
+    return str(date_parser.parse(created_at))
+
+
 def should_continue(message, num_tries, max_tries, sleep_time):
     """Utility method for retry functions"""
     if num_tries < max_tries:
@@ -48,6 +75,33 @@ def should_continue(message, num_tries, max_tries, sleep_time):
         return False
 
 
+class LRUCache:
+    """A thread safe, size bounded, least recently used cache."""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.lock = threading.Lock()
+        self.items = OrderedDict()
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                self.items.move_to_end(key)
+                return self.items[key]
+            except KeyError:
+                return default
+
+    def put(self, key, value):
+        with self.lock:
+            self.items[key] = value
+            self.items.move_to_end(key)
+            if len(self.items) > self.maxsize:
+                self.items.popitem(last=False)
+
+    def __len__(self):
+        return len(self.items)
+
+
 def get_int_default_or_max(val, default_val, max_val=None):
     """Given a string try to turn it into an int and enforce a max and default if the string is not a int value"""
     try:
@@ -65,3 +119,26 @@ if __name__ == '__main__':
     p_url = urlparse(url)
     p_url = cleanse_parse_result(p_url)
     clog.debug(p_url.geturl())
+
+    # Benchmark normalizing synthetic captured tweets, links are tweeted over and over so only a few hundred are distinct
+    import random
+    from chatter.twitter import TweetCaptureDataset
+    logging.getLogger().setLevel(logging.INFO)
+    random.seed(42)
+    links = [f'https://www.site{i % 40}.com/news/story-{i}' for i in range(300)]
+    tweets = []
+    for i in range(20000):
+        tweet = {'id': 10 ** 18 + i, 'text': f'Tweet number {i}', 'created_at': 'Wed Oct 10 20:19:24 +0000 2018',
+                 'user': {'id': random.randrange(5000)},
+                 'entities': {'urls': [{'expanded_url': random.choice(links)}],
+                              'hashtags': [{'text': 'news'}] if i % 3 == 0 else []}}
+        if i % 4 == 0:
+            tweet['retweeted_status'] = {'id_str': str(10 ** 17 + i)}
+        tweets.append(tweet)
+    dataset = TweetCaptureDataset()
+    start = time.time()
+    for tweet in tweets:
+        dataset.add_tweet(tweet)
+    elapsed = time.time() - start
+    clog.info('Normalized %s tweets with %s urls in %.3f seconds, %.0f tweets/sec', len(tweets), len(dataset.urls),
+              elapsed, len(tweets) / elapsed)
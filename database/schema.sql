@@ -33,6 +33,20 @@ SET default_tablespace = '';
 
 SET default_with_oids = false;
 
+--
+-- Name: capture_checkpoints; Type: TABLE; Schema: public; Owner: postgres
+--
+
+CREATE TABLE public.capture_checkpoints (
+    source character varying(20) NOT NULL,
+    checkpoint_key character varying(255) NOT NULL,
+    since_id bigint NOT NULL,
+    updated_at timestamp with time zone
+);
+
+
+ALTER TABLE public.capture_checkpoints OWNER TO postgres;
+
 --
 -- Name: domains; Type: TABLE; Schema: public; Owner: postgres
 --
@@ -46,6 +60,53 @@ CREATE TABLE public.domains (
 
 ALTER TABLE public.domains OWNER TO postgres;
 
+--
+-- Name: hot_url_tweeters; Type: TABLE; Schema: public; Owner: postgres
+--
+
+CREATE TABLE public.hot_url_tweeters (
+    real_url_hash character varying(255) NOT NULL,
+    user_id bigint NOT NULL,
+    first_tweeted timestamp with time zone NOT NULL
+);
+
+
+ALTER TABLE public.hot_url_tweeters OWNER TO postgres;
+
+--
+-- Name: hot_urls; Type: TABLE; Schema: public; Owner: postgres
+--
+
+CREATE TABLE public.hot_urls (
+    real_url_hash character varying(255) NOT NULL,
+    real_url text NOT NULL,
+    domain character varying(255) NOT NULL,
+    total_tweets integer NOT NULL,
+    first_tweeted timestamp with time zone NOT NULL,
+    topics character varying[] DEFAULT '{}'::character varying[] NOT NULL
+);
+
+
+ALTER TABLE public.hot_urls OWNER TO postgres;
+
+--
+-- Name: pending_urls; Type: TABLE; Schema: public; Owner: postgres
+--
+
+CREATE TABLE public.pending_urls (
+    url_hash character varying(255) NOT NULL,
+    url text NOT NULL,
+    domain character varying(255) NOT NULL,
+    added_at timestamp with time zone NOT NULL,
+    attempts integer DEFAULT 0 NOT NULL,
+    next_attempt_at timestamp with time zone NOT NULL,
+    lease_owner character varying(255),
+    lease_expires timestamp with time zone
+);
+
+
+ALTER TABLE public.pending_urls OWNER TO postgres;
+
 --
 -- Name: tweeted_hashtags; Type: TABLE; Schema: public; Owner: postgres
 --
@@ -89,6 +150,33 @@ CREATE TABLE public.tweets (
 
 ALTER TABLE public.tweets OWNER TO postgres;
 
+--
+-- Name: url_classify_failures; Type: TABLE; Schema: public; Owner: postgres
+--
+
+CREATE TABLE public.url_classify_failures (
+    real_url_hash character varying(255) NOT NULL,
+    attempts integer NOT NULL,
+    next_attempt_at timestamp with time zone NOT NULL
+);
+
+
+ALTER TABLE public.url_classify_failures OWNER TO postgres;
+
+--
+-- Name: url_expansions; Type: TABLE; Schema: public; Owner: postgres
+--
+
+CREATE TABLE public.url_expansions (
+    url_hash character varying(255) NOT NULL,
+    url text NOT NULL,
+    expanded_url text NOT NULL,
+    expires_at timestamp with time zone NOT NULL
+);
+
+
+ALTER TABLE public.url_expansions OWNER TO postgres;
+
 --
 -- Name: url_info; Type: TABLE; Schema: public; Owner: postgres
 --
@@ -116,6 +204,20 @@ CREATE TABLE public.url_topics (
 
 ALTER TABLE public.url_topics OWNER TO postgres;
 
+--
+-- Name: url_vectors; Type: TABLE; Schema: public; Owner: postgres
+--
+
+CREATE TABLE public.url_vectors (
+    real_url_hash character varying(255) NOT NULL,
+    model_version integer NOT NULL,
+    vector real[] NOT NULL,
+    updated_at timestamp with time zone NOT NULL
+);
+
+
+ALTER TABLE public.url_vectors OWNER TO postgres;
+
 --
 -- Name: users; Type: TABLE; Schema: public; Owner: postgres
 --
@@ -140,6 +242,14 @@ CREATE TABLE public.users (
 
 ALTER TABLE public.users OWNER TO postgres;
 
+--
+-- Name: capture_checkpoints capture_checkpoints_pkey; Type: CONSTRAINT; Schema: public; Owner: postgres
+--
+
+ALTER TABLE ONLY public.capture_checkpoints
+    ADD CONSTRAINT capture_checkpoints_pkey PRIMARY KEY (source, checkpoint_key);
+
+
 --
 -- Name: domains domains_pkey; Type: CONSTRAINT; Schema: public; Owner: postgres
 --
@@ -148,6 +258,30 @@ ALTER TABLE ONLY public.domains
     ADD CONSTRAINT domains_pkey PRIMARY KEY (domain_set, domain, subset);
 
 
+--
+-- Name: hot_url_tweeters hot_url_tweeters_pkey; Type: CONSTRAINT; Schema: public; Owner: postgres
+--
+
+ALTER TABLE ONLY public.hot_url_tweeters
+    ADD CONSTRAINT hot_url_tweeters_pkey PRIMARY KEY (real_url_hash, user_id);
+
+
+--
+-- Name: hot_urls hot_urls_pkey; Type: CONSTRAINT; Schema: public; Owner: postgres
+--
+
+ALTER TABLE ONLY public.hot_urls
+    ADD CONSTRAINT hot_urls_pkey PRIMARY KEY (real_url_hash);
+
+
+--
+-- Name: pending_urls pending_urls_pkey; Type: CONSTRAINT; Schema: public; Owner: postgres
+--
+
+ALTER TABLE ONLY public.pending_urls
+    ADD CONSTRAINT pending_urls_pkey PRIMARY KEY (url_hash);
+
+
 --
 -- Name: tweeted_hashtags tweeted_hashtags_pkey; Type: CONSTRAINT; Schema: public; Owner: postgres
 --
@@ -172,6 +306,22 @@ ALTER TABLE ONLY public.tweets
     ADD CONSTRAINT tweets_pkey PRIMARY KEY (tweet_id);
 
 
+--
+-- Name: url_classify_failures url_classify_failures_pkey; Type: CONSTRAINT; Schema: public; Owner: postgres
+--
+
+ALTER TABLE ONLY public.url_classify_failures
+    ADD CONSTRAINT url_classify_failures_pkey PRIMARY KEY (real_url_hash);
+
+
+--
+-- Name: url_expansions url_expansions_pkey; Type: CONSTRAINT; Schema: public; Owner: postgres
+--
+
+ALTER TABLE ONLY public.url_expansions
+    ADD CONSTRAINT url_expansions_pkey PRIMARY KEY (url_hash);
+
+
 --
 -- Name: url_info url_info_pkey; Type: CONSTRAINT; Schema: public; Owner: postgres
 --
@@ -188,6 +338,14 @@ ALTER TABLE ONLY public.url_topics
     ADD CONSTRAINT url_topics_pkey PRIMARY KEY (real_url_hash, topic);
 
 
+--
+-- Name: url_vectors url_vectors_pkey; Type: CONSTRAINT; Schema: public; Owner: postgres
+--
+
+ALTER TABLE ONLY public.url_vectors
+    ADD CONSTRAINT url_vectors_pkey PRIMARY KEY (real_url_hash, model_version);
+
+
 --
 -- Name: users users_pkey; Type: CONSTRAINT; Schema: public; Owner: postgres
 --
@@ -203,6 +361,27 @@ ALTER TABLE ONLY public.users
 CREATE INDEX created_at_idx ON public.tweets USING btree (created_at);
 
 
+--
+-- Name: hot_url_tweeters_first_tweeted_idx; Type: INDEX; Schema: public; Owner: postgres
+--
+
+CREATE INDEX hot_url_tweeters_first_tweeted_idx ON public.hot_url_tweeters USING btree (first_tweeted);
+
+
+--
+-- Name: hot_urls_first_tweeted_idx; Type: INDEX; Schema: public; Owner: postgres
+--
+
+CREATE INDEX hot_urls_first_tweeted_idx ON public.hot_urls USING btree (first_tweeted);
+
+
+--
+-- Name: pending_urls_next_attempt_at_idx; Type: INDEX; Schema: public; Owner: postgres
+--
+
+CREATE INDEX pending_urls_next_attempt_at_idx ON public.pending_urls USING btree (next_attempt_at);
+
+
 --
 -- Name: real_url_hash_idx; Type: INDEX; Schema: public; Owner: postgres
 --
@@ -210,6 +389,13 @@ CREATE INDEX created_at_idx ON public.tweets USING btree (created_at);
 CREATE INDEX real_url_hash_idx ON public.tweeted_urls USING btree (real_url_hash);
 
 
+--
+-- Name: url_hash_idx; Type: INDEX; Schema: public; Owner: postgres
+--
+
+CREATE INDEX url_hash_idx ON public.tweeted_urls USING btree (url_hash);
+
+
 --
 -- PostgreSQL database dump complete
 --
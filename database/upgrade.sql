@@ -0,0 +1,146 @@
+--
+-- Brings a database created from an earlier schema.sql up to date.  Every statement is safe to run more than once:
+--
+--   psql --dbname={your database name} --file=database/upgrade.sql
+--
+
+SET client_min_messages = warning;
+
+--
+-- Since_id checkpoints for list and geo capture
+--
+
+CREATE TABLE IF NOT EXISTS public.capture_checkpoints (
+    source character varying(20) NOT NULL,
+    checkpoint_key character varying(255) NOT NULL,
+    since_id bigint NOT NULL,
+    updated_at timestamp with time zone,
+    CONSTRAINT capture_checkpoints_pkey PRIMARY KEY (source, checkpoint_key)
+);
+
+--
+-- Lookups of tweeted urls by url_hash, used to resolve already known urls at capture time
+--
+
+CREATE INDEX IF NOT EXISTS url_hash_idx ON public.tweeted_urls USING btree (url_hash);
+
+--
+-- Cache of where tiny urls redirect to
+--
+
+CREATE TABLE IF NOT EXISTS public.url_expansions (
+    url_hash character varying(255) NOT NULL,
+    url text NOT NULL,
+    expanded_url text NOT NULL,
+    expires_at timestamp with time zone NOT NULL,
+    CONSTRAINT url_expansions_pkey PRIMARY KEY (url_hash)
+);
+
+--
+-- Queue of urls waiting on url maintenance, along with any claim on them held by a running url maintenance process.
+-- It is filled from the tweeted urls that have not been resolved yet once all of its columns are in place, below.
+--
+
+CREATE TABLE IF NOT EXISTS public.pending_urls (
+    url_hash character varying(255) NOT NULL,
+    url text NOT NULL,
+    domain character varying(255) NOT NULL,
+    added_at timestamp with time zone NOT NULL,
+    lease_owner character varying(255),
+    lease_expires timestamp with time zone,
+    CONSTRAINT pending_urls_pkey PRIMARY KEY (url_hash)
+);
+
+CREATE INDEX IF NOT EXISTS pending_urls_added_at_idx ON public.pending_urls USING btree (added_at);
+
+DROP TABLE IF EXISTS public.url_leases;
+
+--
+-- Failed attempts at each pending url and when it is next due to be tried
+--
+
+ALTER TABLE public.pending_urls ADD COLUMN IF NOT EXISTS attempts integer DEFAULT 0 NOT NULL;
+ALTER TABLE public.pending_urls ADD COLUMN IF NOT EXISTS next_attempt_at timestamp with time zone DEFAULT NOW() NOT NULL;
+ALTER TABLE public.pending_urls ALTER COLUMN next_attempt_at DROP DEFAULT;
+
+DROP INDEX IF EXISTS public.pending_urls_added_at_idx;
+CREATE INDEX IF NOT EXISTS pending_urls_next_attempt_at_idx ON public.pending_urls USING btree (next_attempt_at);
+
+-- NOT NULL is checked before ON CONFLICT, so every column without a default has to be given even for urls that are
+-- already queued
+INSERT INTO public.pending_urls (url_hash, url, domain, added_at, next_attempt_at)
+    SELECT DISTINCT ON (url_hash) url_hash, url, domain, NOW(), NOW() FROM public.tweeted_urls
+    WHERE real_url_hash IS NULL
+    ON CONFLICT ON CONSTRAINT pending_urls_pkey DO NOTHING;
+
+--
+-- Rollup of tweeted urls for hot lists, filled from the existing tweets.  Only the recent tweeters are needed, older
+-- ones are pruned by url maintenance.
+--
+
+CREATE TABLE IF NOT EXISTS public.hot_url_tweeters (
+    real_url_hash character varying(255) NOT NULL,
+    user_id bigint NOT NULL,
+    first_tweeted timestamp with time zone NOT NULL,
+    CONSTRAINT hot_url_tweeters_pkey PRIMARY KEY (real_url_hash, user_id)
+);
+
+CREATE INDEX IF NOT EXISTS hot_url_tweeters_first_tweeted_idx ON public.hot_url_tweeters USING btree (first_tweeted);
+
+CREATE TABLE IF NOT EXISTS public.hot_urls (
+    real_url_hash character varying(255) NOT NULL,
+    real_url text NOT NULL,
+    domain character varying(255) NOT NULL,
+    total_tweets integer NOT NULL,
+    first_tweeted timestamp with time zone NOT NULL,
+    topics character varying[] DEFAULT '{}'::character varying[] NOT NULL,
+    CONSTRAINT hot_urls_pkey PRIMARY KEY (real_url_hash)
+);
+
+CREATE INDEX IF NOT EXISTS hot_urls_first_tweeted_idx ON public.hot_urls USING btree (first_tweeted);
+
+INSERT INTO public.hot_url_tweeters (real_url_hash, user_id, first_tweeted)
+    SELECT tu.real_url_hash, t.user_id, MIN(t.created_at) FROM public.tweeted_urls tu
+    INNER JOIN public.tweets t USING (tweet_id)
+    WHERE tu.real_url_hash IS NOT NULL AND t.created_at > NOW() - interval '72 hour'
+    AND EXISTS (SELECT 1 FROM public.url_info ui WHERE ui.real_url_hash = tu.real_url_hash)
+    GROUP BY tu.real_url_hash, t.user_id
+    ON CONFLICT ON CONSTRAINT hot_url_tweeters_pkey DO NOTHING;
+
+INSERT INTO public.hot_urls (real_url_hash, real_url, domain, total_tweets, first_tweeted, topics)
+    SELECT tu.real_url_hash, MIN(tu.real_url), MIN(tu.domain), COUNT(DISTINCT t.user_id), MIN(t.created_at),
+    array(SELECT array[topic, score::character varying] FROM public.url_topics ut
+          WHERE ut.real_url_hash = tu.real_url_hash ORDER BY score DESC)
+    FROM public.tweeted_urls tu INNER JOIN public.tweets t USING (tweet_id)
+    WHERE tu.real_url_hash IS NOT NULL
+    AND EXISTS (SELECT 1 FROM public.url_info ui WHERE ui.real_url_hash = tu.real_url_hash)
+    GROUP BY tu.real_url_hash
+    ON CONFLICT ON CONSTRAINT hot_urls_pkey DO NOTHING;
+
+-- Only urls with metadata can be in a hot list, clear out any others rolled up before they were left out
+DELETE FROM public.hot_url_tweeters hut
+    WHERE NOT EXISTS (SELECT 1 FROM public.url_info ui WHERE ui.real_url_hash = hut.real_url_hash);
+DELETE FROM public.hot_urls hu WHERE NOT EXISTS (SELECT 1 FROM public.url_info ui WHERE ui.real_url_hash = hu.real_url_hash);
+
+--
+-- Topic vectors of urls, filled in by the topicmodel command as it updates the topic model.
+--
+
+CREATE TABLE IF NOT EXISTS public.url_vectors (
+    real_url_hash character varying(255) NOT NULL,
+    model_version integer NOT NULL,
+    vector real[] NOT NULL,
+    updated_at timestamp with time zone NOT NULL,
+    CONSTRAINT url_vectors_pkey PRIMARY KEY (real_url_hash, model_version)
+);
+
+--
+-- Urls whose content the topic classifier rejected, and when each is due to be tried again
+--
+
+CREATE TABLE IF NOT EXISTS public.url_classify_failures (
+    real_url_hash character varying(255) NOT NULL,
+    attempts integer NOT NULL,
+    next_attempt_at timestamp with time zone NOT NULL,
+    CONSTRAINT url_classify_failures_pkey PRIMARY KEY (real_url_hash)
+);